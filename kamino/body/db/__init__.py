@@ -1,35 +1,264 @@
 from ZODB import FileStorage, DB
 
 import os.path
+import time
 
+import transaction
+
+from BTrees.OOBTree import OOBTree
+
+from kamino.body    import fs
 from kamino.body.db import types
 from kamino.body.db import file_store
+from kamino.body.db import codecs
+
+
+# Version of the database layout. Older databases are brought up to date
+# by BodyDB._migrate() when opened for writing:
+#
+#   1  Directory content and PatchedDirectory maps are OOBTrees
+#   2  Entries cache their fq_name and db_root['paths'] indexes them
+#   3  FileSystems keeps the compact inode index
+#   4  Inodes with a single link reference their File
+#
+FORMAT = 4
+
+
+# Storage backends. 'zodb' keeps the objects in kamino.zodb; 'sqlite'
+# keeps them in tables of kamino.sqlite (see sqlite.py)
+BACKENDS = ('zodb', 'sqlite')
+
+# Objects kept per ZODB connection unless a cache_size is given. The
+# sqlite backend takes cache_size as pages of its page cache instead
+CACHE_SIZE = 400
+
+
+# Returns the backend of the database in db_dir. New databases use
+# 'backend', or ZODB if none is given
+def get_backend( db_dir, backend=None ):
+    if backend is not None and not backend in BACKENDS:
+        raise Exception('Unknown database backend: %s' % backend)
+
+    existing = None
+    if os.path.exists( os.path.join(db_dir, 'kamino.sqlite') ):
+        existing = 'sqlite'
+    elif os.path.exists( os.path.join(db_dir, 'kamino.zodb') ):
+        existing = 'zodb'
+
+    if existing is not None and backend is not None and backend != existing:
+        raise Exception('Database %s uses the %s backend' % (db_dir, existing))
+
+    return existing or backend or 'zodb'
 
 
 class BodyDB( object ):
 
-    def __init__(self, db_dir):
+    # Opens SqliteBodyDB instead for sqlite databases
+    def __new__(cls, db_dir, read_only=False, codec=codecs.DEFAULT,
+                inline_threshold=file_store.INLINE_THRESHOLD, backend=None, cache_size=None):
+        if cls is BodyDB and get_backend( db_dir, backend ) == 'sqlite':
+            from kamino.body.db import sqlite
+            cls = sqlite.SqliteBodyDB
+        return object.__new__( cls )
+
+
+    # A read_only BodyDB can be opened alongside a writer. It never
+    # commits, so new mounts are not registered
+    def __init__(self, db_dir, read_only=False, codec=codecs.DEFAULT,
+                 inline_threshold=file_store.INLINE_THRESHOLD, backend=None, cache_size=None):
+        self.db_dir        = db_dir
         self.zodb_file     = os.path.join(db_dir, 'kamino.zodb')
         self.file_store_fn = os.path.join(db_dir, 'file_store')
+        self.journal_fn    = os.path.join(db_dir, 'journal')
+        self.read_only     = read_only
         
-        self.zodb_storage  = FileStorage.FileStorage( self.zodb_file )
-        self.zodb_db       = DB(self.zodb_storage)
+        self.zodb_storage  = FileStorage.FileStorage( self.zodb_file, read_only=read_only )
+        self.zodb_db       = DB(self.zodb_storage, cache_size=cache_size or CACHE_SIZE)
         self.zodb_con      = self.zodb_db.open()
     
         self.db_root  = self.zodb_con.root()
+
+        if read_only and not self.db_root.has_key('/'):
+            raise Exception('Database %s has not been initialized' % db_dir)
     
         if not self.db_root.has_key('/'):
             self.db_root['/']        = types.Directory( '', None, 0, 0, 0755, 0 )
             self.db_root['fs_db']    = types.FileSystems()
             self.db_root['file_db']  = types.FileDatabase()
             self.db_root['patch_db'] = types.PatchDatabase()
+            self.db_root['paths']    = OOBTree() # fq_name => entry of the current tree
+            self.db_root['format']   = FORMAT
 
         self.fs_db    = self.db_root['fs_db']
         self.file_db  = self.db_root['file_db']
         self.patch_db = self.db_root['patch_db']
-        
+
+        self.file_store = file_store.FileStore( self.file_store_fn, self, read_only, codec,
+                                                inline_threshold )
+
+        # Commit policy for scans. See commit()
+        self.commit_ops     = 1000
+        self.commit_seconds = 5.0
+        self.commit_at_dirs = True # Also commit as each directory is completed
+        self.pending_ops    = 0
+        self.last_commit    = time.time()
+
+        if not read_only and self.db_root.get('format', 0) < FORMAT:
+            self._migrate()
+
         # Ensure that all mounted local filesystems have an ID
-        self.fs_db.check_filesystems()
+        if not read_only:
+            self.fs_db.check_filesystems()
+
+        # Maintained by DBUpdater. None for read_only databases that have
+        # not been migrated yet
+        self.path_index = self.db_root.get('paths')
+
+
+    # Returns a BodyDBReader on a connection of its own from the pool
+    def open_reader(self, cache_size=None):
+        return BodyDBReader( self, cache_size )
+
+
+    def close(self):
+        self.file_store.close()
+        self.zodb_con.close()
+        self.zodb_db.close()
+
+
+    # Commits, then writes the FileStorage index, which is otherwise only
+    # saved on close. Read-only opens of the database while it is held
+    # here (e.g. ShardedScanner workers) can then load the index instead
+    # of rebuilding it by reading the whole .zodb file
+    def save_index(self):
+        self.commit( True )
+        self.zodb_storage._save_index()
+
+
+    # Returns the entry at 'path', relative to the scan root, or None.
+    # '/' is the root directory
+    def lookup(self, path):
+        path = path.strip('/')
+
+        if not path:
+            return self.db_root['/']
+
+        if self.path_index is not None:
+            return self.path_index.get( '/' + path )
 
-        self.file_store = file_store.FileStore( self.file_store_fn, self )
+        d = self.db_root['/']
+        for c in path.split('/'):
+            if d.ftype != fs.DIRECTORY:
+                return None
+            d = d.content.get( c )
+            if d is None:
+                return None
+        return d
+
+
+    # Each step may be interrupted and rerun. The format is only raised
+    # once every step is complete
+    def _migrate(self):
+        fmt = self.db_root.get('format', 0)
         
+        if fmt < 1:
+            n = types.convert_directories( self.db_root['/'], self.commit )
+            for p in self.patch_db.patches.itervalues():
+                n += types.convert_patch_directories( p.root, self.commit )
+            print 'DB: converted %d directories to BTrees' % n
+
+        if fmt < 2:
+            # Rebuilt from scratch should an earlier attempt have been
+            # interrupted
+            self.db_root['paths'] = OOBTree()
+            n = types.index_paths( self.db_root['/'], self.db_root['paths'], self.commit )
+            print 'DB: indexed %d paths' % n
+
+        if fmt < 3:
+            self.fs_db.migrate_inode_map( self.commit )
+            print 'DB: inode index holds %s' % self.fs_db.inode_report()
+
+        if fmt < 4:
+            self.fs_db.reference_single_links( self.db_root['paths'], self.commit )
+
+        self.db_root['format'] = FORMAT
+        self.commit( True )
+
+
+    # Records one operation and commits once commit_ops operations are
+    # pending or commit_seconds have passed since the last commit. The
+    # tree, the patch being built and the store allocations for them share
+    # each transaction, so a crash loses whole operations only; the next
+    # scan finds them again and create_patch() resumes the patch
+    def commit(self, force=False):
+        self.pending_ops += 1
+
+        if force or self.pending_ops >= self.commit_ops or \
+           time.time() - self.last_commit >= self.commit_seconds:
+            self.file_store.flush()
+            self._commit_transaction()
+            self.pending_ops = 0
+            self.last_commit = time.time()
+        
+
+
+    def _commit_transaction(self):
+        transaction.commit()
+
+
+
+# A read-only view of a BodyDB through another connection from its pool.
+# ZODB's MVCC keeps the view at the last commit before the reader was
+# opened or refreshed, whatever the BodyDB commits meanwhile, so reports,
+# diffs and patch exports can run in other threads during a scan. A
+# reader must only be used by one thread at a time
+class BodyDBReader( BodyDB ):
+
+    def __init__(self, body_db, cache_size=None):
+        self.body_db       = body_db
+        self.db_dir        = body_db.db_dir
+        self.zodb_file     = body_db.zodb_file
+        self.file_store_fn = body_db.file_store_fn
+        self.journal_fn    = body_db.journal_fn
+        self.read_only     = True
+
+        # Kept apart from the thread's default transaction manager, which
+        # the scan commits through
+        self.transaction_manager = transaction.TransactionManager()
+
+        self.zodb_con = body_db.zodb_db.open( transaction_manager=self.transaction_manager )
+
+        if cache_size is not None:
+            self.zodb_con._cache.cache_size = cache_size # As DB.setCacheSize() does for all
+
+        self._load()
+
+        self.file_store = file_store.FileStore( self.file_store_fn, self, True, body_db.file_store.codec,
+                                                body_db.file_store.inline_threshold )
+
+
+    def _load(self):
+        self.transaction_manager.begin()
+
+        self.db_root    = self.zodb_con.root()
+        self.fs_db      = self.db_root['fs_db']
+        self.file_db    = self.db_root['file_db']
+        self.patch_db   = self.db_root['patch_db']
+        self.path_index = self.db_root.get('paths')
+
+
+    # Moves the view up to the latest commit
+    def refresh(self):
+        self.transaction_manager.abort()
+        self._load()
+
+
+    # Returns the connection to the pool
+    def close(self):
+        self.transaction_manager.abort()
+        self.file_store.close()
+        self.zodb_con.close()
+
+
+    def commit(self, force=False):
+        raise Exception('BodyDB readers cannot commit')
@@ -0,0 +1,160 @@
+# Compression codecs for the file store
+#
+# The codec used for each DBFile is recorded by name:
+#
+#   raw      stored as is
+#   zlib-N   zlib at level N (1-9). 'zlib' alone is the default level and
+#            is what data stored before codecs were recorded uses
+#   bz2-N    bz2 at level N (1-9)
+#   lzma-N   lzma preset N (0-9). Only available where the lzma module,
+#            or backports.lzma on Python 2, can be imported
+#
+import zlib
+import bz2
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+DEFAULT = 'zlib-6'
+
+# Content whose sample compresses to more than this fraction of its size
+# is stored raw
+INCOMPRESSIBLE_RATIO = 0.9
+
+SAMPLE_SIZE  = 8 * 1024
+SAMPLE_COUNT = 3
+
+
+
+class _RawDecompressor (object):
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return ''
+
+
+
+class _Bz2Decompressor (object):
+
+    def __init__(self):
+        self.d = bz2.BZ2Decompressor()
+
+    def decompress(self, data):
+        return self.d.decompress( data )
+
+    def flush(self):
+        return ''
+
+
+
+class _LzmaDecompressor (object):
+
+    def __init__(self):
+        self.d = lzma.LZMADecompressor()
+
+    def decompress(self, data):
+        return self.d.decompress( data )
+
+    def flush(self):
+        return ''
+
+
+
+def _split( codec ):
+    if '-' in codec:
+        family, level = codec.split('-', 1)
+        return family, int(level)
+    return codec, None
+
+
+def check( codec ):
+    family, level = _split( codec )
+
+    if family == 'raw' and level is None:
+        return
+
+    if family == 'zlib' and (level is None or 1 <= level <= 9):
+        return
+
+    if family == 'bz2' and level is not None and 1 <= level <= 9:
+        return
+
+    if family == 'lzma' and level is not None and 0 <= level <= 9:
+        if lzma is None:
+            raise Exception('Codec %s requires the lzma module' % codec)
+        return
+
+    raise Exception('Unknown compression codec: %s' % codec)
+
+
+def compress( codec, data ):
+    family, level = _split( codec )
+
+    if family == 'raw':
+        return data
+    elif family == 'zlib':
+        return zlib.compress( data, 6 if level is None else level )
+    elif family == 'bz2':
+        return bz2.compress( data, level )
+    elif family == 'lzma':
+        return lzma.compress( data, preset = level )
+
+    raise Exception('Unknown compression codec: %s' % codec)
+
+
+def decompressor( codec ):
+    family = _split( codec )[0]
+
+    if family == 'raw':
+        return _RawDecompressor()
+    elif family == 'zlib':
+        return zlib.decompressobj()
+    elif family == 'bz2':
+        return _Bz2Decompressor()
+    elif family == 'lzma':
+        return _LzmaDecompressor()
+
+    raise Exception('Unknown compression codec: %s' % codec)
+
+
+def decompress( codec, data ):
+    d = decompressor( codec )
+    return d.decompress( data ) + d.flush()
+
+
+# Compresses a few slices of data with fast zlib. Already compressed
+# content (.gz, .jpg, .rpm, ...) costs the full compressor's CPU time for
+# no gain, so it is better caught this way
+def compressible( data ):
+    if len(data) <= SAMPLE_SIZE * SAMPLE_COUNT:
+        sample = data[ : SAMPLE_SIZE ]
+    else:
+        step   = (len(data) - SAMPLE_SIZE) / (SAMPLE_COUNT - 1)
+        sample = ''.join( data[ i * step : i * step + SAMPLE_SIZE ] for i in range(SAMPLE_COUNT) )
+
+    if not sample:
+        return True
+
+    return len( zlib.compress( sample, 1 ) ) <= len(sample) * INCOMPRESSIBLE_RATIO
+
+
+# Returns (codec, encoded data). Falls back to raw when the content is
+# detected as incompressible or compression does not shrink it
+def encode( codec, data, detect_incompressible = True ):
+    if codec == 'raw' or (detect_incompressible and not compressible( data )):
+        return 'raw', data
+
+    zdata = compress( codec, data )
+
+    if len(zdata) >= len(data):
+        return 'raw', data
+
+    return codec, zdata
@@ -0,0 +1,204 @@
+# Store garbage collection and compaction
+#
+# Content is referenced by the regular files of the current tree and by
+# the adds and removes of every patch still in the PatchDatabase. The
+# chunks of a referenced manifest are referenced along with it. DBFiles
+# nothing references, which remain after patches are pruned (see
+# PatchDatabase.prune), are removed from the FileDatabase and their space
+# becomes dead.
+#
+# Segments, other than the one currently being appended to, whose live
+# data has fallen below min_live of their size are then compacted: their
+# live data is copied to the end of the store, the DBFiles are updated to
+# point at the copies and the transaction is committed, one segment at a
+# time. The old segment is retired rather than deleted, as read_only
+# BodyDBs opened before the commit may still read from it. Retired
+# segment files are deleted by the next compaction.
+#
+# Everything runs through the BodyDB's own connection, so the database
+# remains usable between segments and scans can resume afterwards.
+#
+import time
+import optparse
+
+from kamino.body    import fs
+from kamino.body.db import BodyDB
+
+
+def _mark_tree( db_dir, live ):
+    for v in db_dir.content.itervalues():
+        if v.ftype == fs.DIRECTORY:
+            _mark_tree( v, live )
+        elif v.ftype == fs.REGULAR and v.file_id is not None:
+            live.add( v.file_id )
+
+
+def _mark_patch( patch_dir, live ):
+    for m in (patch_dir.adds, patch_dir.removes):
+        for v in m.itervalues():
+            if v.ftype == fs.REGULAR and v.file_id is not None:
+                live.add( v.file_id )
+    for s in patch_dir.subdirs.itervalues():
+        _mark_patch( s, live )
+
+
+# Returns the set of referenced file_ids
+def mark( body_db ):
+    live = set()
+
+    _mark_tree( body_db.db_root['/'], live )
+
+    for p in body_db.patch_db.patches.itervalues():
+        _mark_patch( p.root, live )
+
+    files = body_db.file_db.files
+
+    for file_id in list( live ):
+        dbf = files.get( file_id )
+        if dbf is not None and dbf.chunks is not None:
+            live.update( dbf.chunks )
+
+    return live
+
+
+# Removes unreferenced DBFiles and recounts the live bytes of each
+# segment. Returns (files removed, bytes released)
+def sweep( body_db, live ):
+    fdb      = body_db.file_db
+    segs     = fdb.get_segments()
+    counts   = dict()
+    nremoved = 0
+    nbytes   = 0
+
+    for file_id, dbf in list( fdb.files.iteritems() ):
+        if file_id in live:
+            if dbf.zlength:
+                counts[ dbf.segment ] = counts.get( dbf.segment, 0 ) + dbf.zlength
+        else:
+            nremoved += 1
+            nbytes   += dbf.zlength
+            fdb.remove_file( file_id )
+
+    for n, s in segs.iteritems():
+        if s.live != counts.get( n, 0 ):
+            s.live = counts.get( n, 0 )
+
+    body_db.commit( True )
+
+    return nremoved, nbytes
+
+
+
+class Compactor (object):
+
+    def __init__(self, body_db, min_live = 0.5):
+        self.body_db  = body_db
+        self.min_live = min_live
+
+        self.files_removed    = 0
+        self.bytes_removed    = 0
+        self.segments_deleted = 0
+        self.segments_written = 0
+        self.bytes_moved      = 0
+        self.bytes_reclaimed  = 0
+        self.elapsed          = 0.0
+
+
+    def _delete_retired(self):
+        fdb = self.body_db.file_db
+
+        if fdb.retired:
+            for n in fdb.retired:
+                self.body_db.file_store.delete_segment( n )
+                self.segments_deleted += 1
+            del fdb.retired[:]
+            self.body_db.commit( True )
+
+
+    def candidates(self):
+        fdb = self.body_db.file_db
+        return [ s for n, s in fdb.get_segments().items()
+                 if n != fdb.current_segment and s.size > 0 and s.live < s.size * self.min_live ]
+
+
+    def compact_segment(self, seg):
+        fdb   = self.body_db.file_db
+        store = self.body_db.file_store
+
+        dbfs = [ dbf for dbf in fdb.files.itervalues() if dbf.zlength and dbf.segment == seg.number ]
+        dbfs.sort( key = lambda dbf: dbf.offset )
+
+        for dbf in dbfs:
+            store.relocate( dbf )
+            self.bytes_moved += dbf.zlength
+
+        store.flush()
+
+        self.bytes_reclaimed  += seg.size - sum( dbf.zlength for dbf in dbfs )
+        self.segments_written += 1
+
+        del fdb.get_segments()[ seg.number ]
+        fdb.retired.append( seg.number )
+
+        self.body_db.commit( True )
+
+
+    def run(self):
+        t = time.time()
+
+        self._delete_retired()
+
+        live = mark( self.body_db )
+
+        self.files_removed, self.bytes_removed = sweep( self.body_db, live )
+
+        live = None
+
+        for seg in self.candidates():
+            self.compact_segment( seg )
+
+        self.elapsed = time.time() - t
+
+
+    def report(self):
+        return '%d unreferenced files removed (%d bytes), %d segments compacted, ' \
+               '%d bytes moved, %d bytes reclaimed, %d retired segment files deleted in %.3f s' % (
+                   self.files_removed, self.bytes_removed, self.segments_written,
+                   self.bytes_moved, self.bytes_reclaimed, self.segments_deleted, self.elapsed )
+
+
+
+def compact( body_db, min_live = 0.5 ):
+    c = Compactor( body_db, min_live )
+    c.run()
+    return c
+
+
+
+def main():
+    parser = optparse.OptionParser( usage = '%prog [options] DB_DIR' )
+    parser.add_option( '-m', '--min-live', type = 'float', default = 0.5,
+                       help = 'Compact segments whose live data is below this fraction of their size' )
+    parser.add_option( '-p', '--prune-before', type = 'int',
+                       help = 'First discard the patches numbered below this one' )
+
+    opts, args = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error( 'A database directory is required' )
+
+    body_db = BodyDB( args[0] )
+
+    if opts.prune_before is not None:
+        body_db.patch_db.prune( opts.prune_before )
+        body_db.commit( True )
+
+    c = compact( body_db, opts.min_live )
+
+    print 'COMPACT: %s' % c.report()
+    print 'COMPACT: %d bytes in %d segments' % (body_db.file_db.get_store_size(),
+                                                len(body_db.file_db.get_segments()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,77 +1,717 @@
+# File content is compressed with the store's codec (see codecs.py) and
+# appended to the current segment of the store. Content that does not
+# compress is stored raw. Files of CDC_MIN_FILE_SIZE bytes or more are split into content
+# defined chunks (see cdc_cut in fs/cimpl.c) and each chunk is stored as
+# a DBFile of its own; the file's DBFile is then a manifest that stores
+# no data and lists the file_ids of its chunks. Chunk boundaries depend
+# only on the content around them, so appending to or modifying part of
+# a large file only stores the chunks that changed.
+#
+# Whole files and chunks are deduplicated through the content hash index
+# of the FileDatabase.
+#
+# Chunks are compressed independently, so the chunks of a single large
+# file are compressed, and decompressed on extraction, in parallel on a
+# FramePool. zlib and bz2 release the GIL while they work.
+#
+# The store is a series of segment files of up to FileDatabase.segment_size
+# bytes each. Segment 0 is the file named by file_store_fn and segment N
+# is that name with '.N' appended. Space is allocated through the
+# FileDatabase, so it is only claimed once the transaction commits and
+# the data is always written at an explicit offset; a crash leaves, at
+# worst, bytes that are overwritten later. See compactor.py for the
+# reclamation of space that is no longer referenced.
+#
+# Files of up to inline_threshold bytes bypass the store altogether. Their
+# encoded content is kept in the File record (see encode_inline), which
+# saves a DBFile and a store read per file on trees of small files.
+#
+import os
+import sys
+import bisect
+import hashlib
+import tempfile
+import threading
+import collections
+import multiprocessing
+import Queue
 
-import zlib
+from kamino.body.fs import cwrap
+from kamino.body.db import codecs
 
-CHUNK_SIZE = 1024 * 1024
+CHUNK_SIZE        = 1024 * 1024 # I/O size
 
-class FileStore (object):
+CDC_MIN_CHUNK     = 64 * 1024
+CDC_MAX_CHUNK     = 1024 * 1024
+CDC_MASK          = ((1 << 18) - 1) << 46 # Averages CDC_MIN_CHUNK + 256 KB
+CDC_MIN_FILE_SIZE = CDC_MAX_CHUNK
+
+INLINE_THRESHOLD  = 512
+
+SPOOL_SIZE        = 4 * 1024 * 1024 # Compressed bytes held in memory by compress_to_spool
+
+
+def _read_blocks( f, size ):
+    nread = 0
+    while nread < size:
+        block = f.read( min(CHUNK_SIZE, size - nread) )
+        if not block:
+            break # Truncated since it was scanned
+        nread += len(block)
+        yield block
+
+
+# As _read_blocks, but the data must not end early
+def _read_exactly( f, size ):
+    nread = 0
+    for block in _read_blocks( f, size ):
+        nread += len(block)
+        yield block
+    if nread != size:
+        raise Exception('Unexpected end of data: %d of %d bytes read' % (nread, size))
+
+
+def _write_all( fd, data ):
+    while data:
+        data = data[ os.write( fd, data ): ]
+
+
+# Yields the content of up to 'size' bytes of the open file f as the
+# chunks it is stored in. Always yields at least one, possibly empty,
+# chunk
+def split_content( f, size ):
+    if size < CDC_MIN_FILE_SIZE:
+        yield ''.join( _read_blocks( f, size ) )
+        return
+
+    buf     = ''
+    off     = 0
+    yielded = False
+
+    for block in _read_blocks( f, size ):
+        buf = buf[ off: ] + block
+        off = 0
+        while len(buf) - off >= CDC_MAX_CHUNK:
+            n = cwrap.cdc_cut( buf, off, CDC_MIN_CHUNK, CDC_MAX_CHUNK, CDC_MASK )
+            yield buf[ off : off + n ]
+            off    += n
+            yielded = True
+
+    while off < len(buf):
+        n = cwrap.cdc_cut( buf, off, CDC_MIN_CHUNK, CDC_MAX_CHUNK, CDC_MASK )
+        yield buf[ off : off + n ]
+        off    += n
+        yielded = True
+
+    if not yielded:
+        yield ''
+
+
+class _Frame (object):
+
+    def __init__(self, func, arg):
+        self.func     = func
+        self.arg      = arg
+        self.done     = threading.Event()
+        self.result   = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.result = self.func( self.arg )
+        except Exception:
+            self.exc_info = sys.exc_info()
+        self.arg = None
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+
+class FramePool (object):
+
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+        self.jobs        = Queue.Queue()
+
+        for i in range(num_threads):
+            t = threading.Thread( target = self._work )
+            t.daemon = True
+            t.start()
+
+    def _work(self):
+        while True:
+            self.jobs.get().run()
+
+    # Yields func(x) for each x in items, in order. Items are pulled from
+    # the iterator on the calling thread, at most 'window' ahead of the
+    # result being yielded
+    def imap(self, func, items, window = None):
+        window  = window or self.num_threads * 2
+        pending = collections.deque()
+
+        for x in items:
+            f = _Frame( func, x )
+            pending.append( f )
+            self.jobs.put( f )
+            
+            if len(pending) >= window:
+                yield pending.popleft().wait()
+
+        while pending:
+            yield pending.popleft().wait()
+
+
+
+def _imap( pool, func, items ):
+    if pool is None:
+        return ( func(x) for x in items )
+    return pool.imap( func, items )
+
+
+class _Encoder (object):
+
+    def __init__(self, codec, detect_incompressible):
+        self.codec  = codec
+        self.detect = detect_incompressible
+
+    # Returns (length, digest, codec, zdata) for a (length, digest, data)
+    # frame. Frames without data are passed through with codec and zdata
+    # None
+    def __call__(self, frame):
+        length, digest, data = frame
+        if data is None:
+            return length, digest, None, None
+        codec, zdata = codecs.encode( self.codec, data, self.detect )
+        return length, digest, codec, zdata
+
+
+def _decode( frame ):
+    codec, zdata = frame
+    return codecs.decompress( codec, zdata )
+
+    
+# Chunks, hashes and compresses up to 'size' bytes of the named file into
+# out. Returns (length, digest, chunks) where chunks is a list of
+# (offset, length, digest, zoffset, zlength, codec) and zoffset is
+# relative to the initial position of out. Chunks for which
+# known(digest, length) returns True are not compressed; their zoffset
+# and codec are None. known is called on the calling thread
+def compress_file( filename, size, out, codec = codecs.DEFAULT, detect_incompressible = True,
+                   pool = None, known = None ):
+    h       = hashlib.sha256()
+    length  = 0
+    zlength = 0
+    chunks  = list()
 
-    def __init__(self, file_store_fn, body_db):
+    with open( filename, 'rb' ) as f:
+        def frames():
+            for data in split_content( f, size ):
+                h.update( data )
+                digest = hashlib.sha256( data ).digest()
+                if known is not None and known( digest, len(data) ):
+                    yield len(data), digest, None
+                else:
+                    yield len(data), digest, data
         
-        self.file_store = open( file_store_fn, 'ab+' )
-        self.file_db    = body_db.file_db
+        for n, digest, used, zdata in _imap( pool, _Encoder( codec, detect_incompressible ), frames() ):
+            if zdata is None:
+                chunks.append( (length, n, digest, None, 0, None) )
+            else:
+                out.write( zdata )
+                chunks.append( (length, n, digest, zlength, len(zdata), used) )
+                zlength += len(zdata)
+            length += n
+
+    return length, h.digest(), chunks
+
+
+
+# File content compressed ahead of storing it, either by
+# FileStore.add_file itself or by kamino.body.db.pipeline, which attaches
+# it to fs.File.compressed
+class CompressedData (object):
+
+    def __init__(self, length, digest, chunks, zfile):
+        self.length  = length
+        self.digest  = digest
+        self.chunks  = chunks
+        self.zfile   = zfile
+
+    def copy_to(self, out, zoffset, zlength):
+        self.zfile.seek( zoffset )
+        for block in _read_blocks( self.zfile, zlength ):
+            out.write( block )
+
+    def close(self):
+        self.zfile.close()
+
+
+# As compress_file, but into a spooled temporary file. Returns a
+# CompressedData
+def compress_to_spool( filename, size, codec = codecs.DEFAULT, detect_incompressible = True,
+                       pool = None, spool_size = SPOOL_SIZE, known = None ):
+    zf = tempfile.SpooledTemporaryFile( spool_size, prefix = 'kamino_z' )
+    try:
+        length, digest, chunks = compress_file( filename, size, zf, codec, detect_incompressible, pool,
+                                                known )
+    except:
+        zf.close()
+        raise
+    return CompressedData( length, digest, chunks, zf )
 
 
-    def import_data(self, file_obj, nbytes):
-        nwritten = 0
+
+class FileStore (object):
+
+    def __init__(self, file_store_fn, body_db, read_only = False, codec = codecs.DEFAULT,
+                 inline_threshold = INLINE_THRESHOLD):
+
+        codecs.check( codec )
         
-        self.file_store.seek( self.file_db.get_last_offset() )
+        self.file_store_fn = file_store_fn
+        self.file_db       = body_db.file_db
+        self.read_only     = read_only
+        self.segment_files = dict() # segment number => open file. Opened on first use
+
+        self.codec                 = codec
+        self.detect_incompressible = True
+        self.inline_threshold      = inline_threshold # None stores everything in the store
+
+        self.num_threads           = multiprocessing.cpu_count() # Frame compression threads
+        self.pool                  = None # Created on first use
+
+        self.zero_copy             = True
+        self.kernel_copied         = 0
+
+        self.files_added  = 0
+        self.dedup_hits   = 0
+        self.chunks_added = 0
+        self.chunk_hits   = 0
+        self.dedup_bytes  = 0 # Uncompressed bytes
+        self.raw_chunks   = 0 # Stored uncompressed
+        self.bytes_in     = 0
+        self.bytes_out    = 0
+        self.inlined      = 0
+        self.inline_bytes = 0 # Encoded
+
+
+    def segment_fn(self, segment):
+        if segment == 0:
+            return self.file_store_fn
+        return '%s.%d' % (self.file_store_fn, segment)
+
+    
+    def _segment(self, segment):
+        f = self.segment_files.get( segment )
         
-        while nwritten != nbytes:
-            chunk = file_obj.read( min(CHUNK_SIZE, nbytes-nwritten) )
-            self.file_store.write( chunk )
-            nwritten += len(chunk)
+        if f is None:
+            fn = self.segment_fn( segment )
+            
+            if self.read_only:
+                f = open( fn, 'rb' )
+            else:
+                if not os.path.exists( fn ):
+                    open( fn, 'ab' ).close()
+                f = open( fn, 'r+b' )
+                
+            self.segment_files[ segment ] = f
+            
+        return f
+
+
+    def flush(self):
+        for f in self.segment_files.itervalues():
+            f.flush()
+
+
+    def close(self):
+        for f in self.segment_files.itervalues():
+            f.close()
+        self.segment_files = dict()
+
 
+    # Closes and deletes the file of a segment that no longer holds data
+    def delete_segment(self, segment):
+        f = self.segment_files.pop( segment, None )
+        if f is not None:
+            f.close()
+        try:
+            os.unlink( self.segment_fn( segment ) )
+        except OSError:
+            pass
 
-    def export_data(self, file_obj, offset, nbytes):
-        nwritten = 0
+    
+    # Returns the segment file, positioned for writing, and the
+    # (segment, offset) allocated for zlength bytes of new data
+    def _reserve(self, zlength):
+        location = self.file_db.allocate( zlength )
+        f        = self._segment( location[0] )
+        f.seek( location[1] )
+        return f, location
+
+
+    def _read_zdata(self, dbf):
+        f = self._segment( dbf.segment )
+        f.seek( dbf.offset )
+        return ''.join( _read_blocks( f, dbf.zlength ) )
+
+    
+    # import_data and export_data copy between file descriptors inside
+    # the kernel where possible (see cwrap.copy_range) and fall back to
+    # buffered copies through Python. file_obj is left positioned after
+    # the data. import_data allocates space for the data unless a
+    # location from FileDatabase.allocate() is given
+    def import_data(self, file_obj, nbytes, location = None):
+        if location is None:
+            location = self.file_db.allocate( nbytes )
+
+        segment, offset = location
         
-        self.file_store.seek( offset )
+        self._segment( segment )
+        self.flush()
+
+        pos = file_obj.tell()
+
+        # Write through a separate descriptor so that the segment's file
+        # object never holds stale buffered data
+        out = os.open( self.segment_fn( segment ), os.O_WRONLY )
+        try:
+            copied = self._kernel_copy( file_obj, pos, out, offset, nbytes )
+
+            if copied < nbytes:
+                file_obj.seek( pos + copied )
+                os.lseek( out, offset + copied, os.SEEK_SET )
+                for block in _read_exactly( file_obj, nbytes - copied ):
+                    _write_all( out, block )
+        finally:
+            os.close( out )
+
+        file_obj.seek( pos + nbytes )
+
+
+    def export_data(self, file_obj, offset, nbytes, segment = 0):
+        self.flush()
+        file_obj.flush()
+
+        src    = self._segment( segment )
+        pos    = file_obj.tell()
+        copied = self._kernel_copy( src, offset, file_obj, pos, nbytes )
+
+        file_obj.seek( pos + copied )
+
+        if copied < nbytes:
+            src.seek( offset + copied )
+            for block in _read_exactly( src, nbytes - copied ):
+                file_obj.write( block )
+
+
+    # Writes the stored data of each DBFile in turn. Runs of files that
+    # are adjacent in a segment are copied at once
+    def export_files(self, file_obj, dbfs):
+        run = None # [segment, offset, nbytes]
         
-        while nwritten != nbytes:
-            chunk = self.file_store.read( min(CHUNK_SIZE, nbytes-nwritten) )
-            file_obj.write( chunk )
-            nwritten += len(chunk)
+        for dbf in dbfs:
+            if not dbf.zlength:
+                continue
+            if run and run[0] == dbf.segment and run[1] + run[2] == dbf.offset:
+                run[2] += dbf.zlength
+            else:
+                if run:
+                    self.export_data( file_obj, run[1], run[2], run[0] )
+                run = [ dbf.segment, dbf.offset, dbf.zlength ]
+
+        if run:
+            self.export_data( file_obj, run[1], run[2], run[0] )
+
+
+    # Reads data written by export_files. Returns the (segment, offset)
+    # allocated for each of the given compressed lengths; (None, 0) for
+    # those of zero
+    def import_files(self, file_obj, zlengths):
+        locations = list()
+        run       = None # [segment, offset, nbytes]
+
+        for zlength in zlengths:
+            if not zlength:
+                locations.append( (None, 0) )
+                continue
+            
+            location = self.file_db.allocate( zlength )
+            locations.append( location )
+
+            if run and run[0] == location[0] and run[1] + run[2] == location[1]:
+                run[2] += zlength
+            else:
+                if run:
+                    self.import_data( file_obj, run[2], run[:2] )
+                run = [ location[0], location[1], zlength ]
+
+        if run:
+            self.import_data( file_obj, run[2], run[:2] )
+
+        return locations
+
+
+    # Copies the data of dbf to newly allocated space and points dbf at
+    # it. The old space is left for the caller to account for
+    def relocate(self, dbf):
+        src = self._segment( dbf.segment )
+        src.seek( dbf.offset )
+
+        out, location = self._reserve( dbf.zlength )
+
+        for block in _read_exactly( src, dbf.zlength ):
+            out.write( block )
+
+        dbf.segment, dbf.offset = location
+
+
+    # Either side may be a file object or a descriptor
+    def _kernel_copy(self, src, src_offset, dst, dst_offset, nbytes):
+        if not self.zero_copy:
+            return 0
+        try:
+            in_fd  = src if isinstance( src, int ) else src.fileno()
+            out_fd = dst if isinstance( dst, int ) else dst.fileno()
+        except (AttributeError, IOError):
+            return 0 # Not backed by a file
+        n = cwrap.copy_range( in_fd, src_offset, out_fd, dst_offset, nbytes )
+        self.kernel_copied += n
+        return n
 
             
         
+    def stores_inline(self, size):
+        return self.inline_threshold is not None and size <= self.inline_threshold
+
+
+    # Returns the (codec, data) to keep in the File record of a file small
+    # enough to be stored inline, or None
+    def encode_inline(self, fs_f, force_zero_length = False):
+        if force_zero_length and self.inline_threshold is not None:
+            data = ''
+        elif self.stores_inline( fs_f.size ):
+            with open( fs_f.fq_name, 'rb' ) as f:
+                data = ''.join( _read_blocks( f, fs_f.size ) )
+        else:
+            return None
+
+        codec, zdata = codecs.encode( self.codec, data, self.detect_incompressible )
+
+        self.inlined      += 1
+        self.inline_bytes += len(zdata)
+
+        return codec, zdata
+
+            
+    # Content that is already in the store is not stored again; the
+    # existing file_id is returned instead. Files are hashed and compressed
+    # in a single read. Chunks already in the store, or earlier in the
+    # same file, are only hashed
     def add_file(self, fs_f, force_zero_length = False):
         
         if force_zero_length:
             return self.file_db.add_file( 0, 0 )
-        
-        self.file_store.seek( self.file_db.get_last_offset() )
 
-        c = zlib.compressobj()
+        cd = fs_f.compressed
+        fs_f.compressed = None
+
+        try:
+            if cd is None:
+                seen = set()
+
+                def known(digest, length):
+                    if digest in seen or self.file_db.find_content( digest, length ) is not None:
+                        return True
+                    seen.add( digest )
+                    return False
+
+                cd = compress_to_spool( fs_f.fq_name, fs_f.size, self.codec, self.detect_incompressible,
+                                        self.get_pool(), known = known )
+
+            length, digest, chunks = cd.length, cd.digest, cd.chunks
+
+            self.files_added += 1
+
+            file_id = self.file_db.find_content( digest, length )
+
+            if file_id is not None:
+                self.dedup_hits  += 1
+                self.dedup_bytes += length
+                return file_id
+
+            ids = self._store_chunks( chunks, cd )
+
+        finally:
+            if cd is not None:
+                cd.close()
+
+        if len(ids) == 1:
+            return ids[0]
+
+        # Uncompressed offset of each chunk, for read_range()
+        starts = list()
+        length = 0
+        for i in ids:
+            starts.append( length )
+            length += self.file_db.files[ i ].length
         
-        with open( fs_f.fq_name, 'r' ) as f:
-            nwritten = 0
-            zwritten = 0
+        return self.file_db.add_file( length, 0, digest, tuple(ids), chunk_offsets = tuple(starts) )
+
+
+    # Returns the file_ids of the chunks
+    def _store_chunks(self, chunks, cd):
+        ids     = [ None ] * len(chunks)
+        first   = dict()  # digest => index of the chunk that stores it
+        missing = list()
+
+        for i, c in enumerate( chunks ):
+            offset, length, digest = c[:3]
+            
+            self.chunks_added += 1
             
-            while nwritten < fs_f.size:
-                chunk  = f.read( CHUNK_SIZE )
-                zchunk = c.compress( chunk )
-                if len(chunk) < CHUNK_SIZE:
-                    zchunk += c.flush()
-                self.file_store.write( zchunk )
-                nwritten += len(chunk)
-                zwritten += len(zchunk)
+            ids[i] = self.file_db.find_content( digest, length )
+
+            if ids[i] is not None or digest in first:
+                self.chunk_hits  += 1
+                self.dedup_bytes += length
+            else:
+                first[ digest ] = i
+                missing.append( i )
+
+        for i in missing:
+            offset, length, digest, zoffset, zlength, codec = chunks[i]
+            out, location = self._reserve( zlength )
+            cd.copy_to( out, zoffset, zlength )
+            ids[i] = self._add_chunk( length, zlength, digest, codec, location )
+
+        for i, c in enumerate( chunks ):
+            if ids[i] is None:
+                ids[i] = ids[ first[ c[2] ] ]
+
+        return ids
+
+
+    def _add_chunk(self, length, zlength, digest, codec, location):
+        if codec == 'raw':
+            self.raw_chunks += 1
+        self.bytes_in  += length
+        self.bytes_out += zlength
+
+        return self.file_db.add_file( length, zlength, digest, None, codec, location = location if zlength else None )
+
+
+    def get_pool(self):
+        if self.pool is None and self.num_threads > 1:
+            self.pool = FramePool( self.num_threads )
+        return self.pool
+
+
+    def dedup_report(self):
+        if not self.files_added:
+            return 'no file content stored'
+        return '%d files, %d deduplicated (%.1f%% hit rate), %d of %d chunks reused, %d bytes not stored' % (
+            self.files_added, self.dedup_hits, 100.0 * self.dedup_hits / self.files_added,
+            self.chunk_hits, self.chunks_added, self.dedup_bytes )
+
+    def compression_report(self):
+        return '%s, %d bytes stored as %d (%.1f%%), %d chunks stored raw, %d files inline in %d bytes' % (
+            self.codec, self.bytes_in, self.bytes_out,
+            100.0 * self.bytes_out / self.bytes_in if self.bytes_in else 100.0, self.raw_chunks,
+            self.inlined, self.inline_bytes )
+
+
+    # Writes the content of a DBFile to the named file
+    def extract(self, to_filename, dbf):
+        with open( to_filename, 'w' ) as f:
+            if dbf.chunks is None:
+                self._decompress( f, dbf.offset, dbf.zlength, dbf.codec, dbf.segment )
+            else:
+                def frames():
+                    for chunk_id in dbf.chunks:
+                        c = self.file_db.files[ chunk_id ]
+                        yield c.codec, self._read_zdata( c )
 
-        return self.file_db.add_file( fs_f.size, zwritten )
+                for data in _imap( self.get_pool(), _decode, frames() ):
+                    f.write( data )
 
     
-    def extract_file(self, to_filename, offset, num_zbytes):
+    # Returns up to 'length' bytes of the content of file_id, starting at
+    # 'offset'. Only the chunks covering the range are read. Files that are
+    # not chunked are inflated from their start up to the end of the range
+    def read_range(self, file_id, offset, length):
+        dbf = self.file_db.files[ file_id ]
+        end = min( offset + length, dbf.length )
+
+        if offset >= end:
+            return ''
+
+        if dbf.chunks is None:
+            return self._read_stream( dbf, offset, end )
+
+        starts = self.file_db.get_chunk_offsets( dbf )
+        first  = bisect.bisect_right( starts, offset ) - 1
+        last   = bisect.bisect_left( starts, end )
+
+        def frames():
+            for chunk_id in dbf.chunks[ first : last ]:
+                c = self.file_db.files[ chunk_id ]
+                yield c.codec, self._read_zdata( c )
+
+        data = ''.join( _imap( self.get_pool() if last - first > 1 else None, _decode, frames() ) )
+        base = starts[ first ]
+
+        return data[ offset - base : end - base ]
+
+
+    def _read_stream(self, dbf, offset, end):
+        src = self._segment( dbf.segment )
+        src.seek( dbf.offset )
+
+        d     = codecs.decompressor( dbf.codec )
+        out   = list()
+        pos   = 0
+        nread = 0
+
+        while pos < end:
+            if nread < dbf.zlength:
+                z      = src.read( min(CHUNK_SIZE, dbf.zlength - nread) )
+                nread += len(z)
+                data   = d.decompress( z )
+            else:
+                data   = d.flush()
+                if not data:
+                    break
+
+            if pos + len(data) > offset:
+                out.append( data[ max(0, offset - pos) : end - pos ] )
+            pos += len(data)
+
+        return ''.join( out )
+
+    
+    def extract_file(self, to_filename, offset, num_zbytes, segment = 0):
         with open( to_filename, 'w' ) as f:
-            self.file_store.seek( offset )
+            self._decompress( f, offset, num_zbytes, 'zlib', segment )
 
-            nread = 0
-            d     = zlib.decompressobj()
-            
-            while nread != num_zbytes:
-                chunk = self.file_store.read( min(CHUNK_SIZE, num_zbytes-nread) )
-                nread += len(chunk)
 
-                f.write( d.decompress(chunk) )
+    def _decompress(self, f, offset, num_zbytes, codec = 'zlib', segment = 0):
+        nread = 0
+        d     = codecs.decompressor( codec )
 
-            f.write( d.flush() )
-            
-                
+        if num_zbytes:
+            src = self._segment( segment )
+            src.seek( offset )
+
+        while nread != num_zbytes:
+            chunk = src.read( min(CHUNK_SIZE, num_zbytes-nread) )
+            nread += len(chunk)
+
+            f.write( d.decompress(chunk) )
+
+        f.write( d.flush() )
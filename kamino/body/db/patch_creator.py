@@ -1,5 +1,5 @@
 
-import transaction
+import os
 
 from   kamino.body               import fs
 from   kamino.body.db            import types
@@ -26,6 +26,9 @@ class PatchCreator (object):
         self._tdir        = None
         self.have_content = False
         self.dstack       = list()
+        self.start_times  = os.times()
+
+        db_updater.auto_commit = False
 
 
     def _get_t(self):
@@ -74,9 +77,15 @@ class PatchCreator (object):
         if len(self.dstack) == 0:
             if self.have_content:
                 self.proot.set_complete( self.body_db )
-                transaction.commit()
+                self.body_db.commit( True )
                 print 'PATCH Completed: ', self.proot.id_number
+                print 'PATCH Content: ', self.body_db.file_store.dedup_report()
+                print 'PATCH Compression: ', self.body_db.file_store.compression_report()
+                t = os.times()
+                print 'PATCH CPU: %.2f s user, %.2f s system' % (t[0] - self.start_times[0],
+                                                                  t[1] - self.start_times[1])
             else:
+                self.body_db.commit( True )
                 print 'PATCH: No changes detected'
 
         
@@ -88,6 +97,9 @@ class PatchCreator (object):
             p_file.size     = db_file.size
             p_file.mtime_ns = db_file.mtime_ns
 
+            if db_file.inline is not None:
+                p_file.inline = db_file.inline
+
         elif db_file.ftype == fs.SYMLINK:
             p_file.target = db_file.target
 
@@ -109,7 +121,7 @@ class PatchCreator (object):
         
         self.this_dir.adds[ p_file.name ] = p_file
 
-        transaction.commit()
+        self.body_db.commit()
 
 
     
@@ -122,6 +134,8 @@ class PatchCreator (object):
 
         self.db_updater.content_removed( db_file )
 
+        self.body_db.commit()
+
         
 
     def metadata_changed(self, db_file, fs_file):
@@ -131,6 +145,8 @@ class PatchCreator (object):
         #print self.indent, 'Patch Meta: ', fs_file.name, (fs_file.uid, fs_file.gid, fs_file.mode), ' ==> ', (db_file.uid, db_file.gid, db_file.mode)
         
         self.db_updater.metadata_changed( db_file, fs_file )
+
+        self.body_db.commit()
         
         
         
@@ -149,6 +165,8 @@ class PatchCreator (object):
         
         self.db_updater.directory_removed( db_dir )
 
+        self.body_db.commit()
+
         
     # Called in a top-down manner
     def directory_added(self, fs_dir):
@@ -163,3 +181,10 @@ class PatchCreator (object):
         
         self.db_updater.directory_added( fs_dir )
 
+        self.body_db.commit()
+
+
+    def directory_scanned(self, fs_dir):
+        self.db_updater.directory_scanned( fs_dir )
+
+        self.body_db.commit( self.body_db.commit_at_dirs )
@@ -0,0 +1,183 @@
+# Pipelined patch creation
+#
+# PipelinedDelta sits between the Scanner and a PatchCreator (or any other
+# Delta) and splits patch creation into three stages:
+#
+#   scan     - the Scanner, on the calling thread, queues delta events
+#   compress - worker threads read and zlib-compress the content of new
+#              regular files into spooled temporary files
+#   write    - the queued events are replayed, in order, on the calling
+#              thread. FileStore.add_file copies the already compressed
+#              data into the store and the transaction is committed
+#
+# The ZODB connection is not thread safe, so the scan and write stages
+# share the calling thread; events are replayed whenever the head of the
+# queue is ready. zlib releases the GIL while deflating, so compression
+# proceeds in parallel with the scan and with itself.
+#
+# The queue is bounded by the number of pending events and by the number
+# of bytes awaiting compression. The scan blocks on the head of the queue
+# once either bound is reached. The final pop_dir drains the queue, so
+# scan() returns with every event applied.
+#
+# Hard-linked files may resolve to content that is already stored, so
+# they are left for the writer to compress inline if need be.
+#
+# Pre-compression needs the FileStore the writer will add to, for its
+# codec settings. It is taken from the store argument or, failing that,
+# from the wrapped Delta's body_db (as with PatchCreator and DBUpdater).
+# Without one, events are still queued and replayed in order but nothing
+# is compressed ahead of the writer.
+#
+import threading
+import Queue
+
+from kamino.body            import fs
+from kamino.body.scanner    import Delta
+from kamino.body.db         import file_store
+
+
+class _Compression (object):
+
+    def __init__(self, fs_file):
+        self.fs_file = fs_file
+        self.done    = threading.Event()
+        self.data    = None  # file_store.CompressedData
+        self.error   = None
+
+
+    def run(self, spool_size, store, pool):
+        try:
+            self.data = file_store.compress_to_spool( self.fs_file.fq_name, self.fs_file.size, store.codec,
+                                                      store.detect_incompressible, pool, spool_size )
+        except Exception, e:
+            self.error = e
+        self.done.set()
+
+
+
+class PipelinedDelta (Delta):
+
+    def __init__(self, delta, num_workers = 2, max_events = 10000,
+                 max_pending_bytes = 256 * 1024 * 1024, spool_size = file_store.SPOOL_SIZE,
+                 store = None):
+        if store is None and getattr( delta, 'body_db', None ) is not None:
+            store = delta.body_db.file_store
+
+        self.delta             = delta
+        self.store             = store # For the codec settings. None disables pre-compression
+        self.pool              = None  # Compresses the chunks of large files
+        self.max_events        = max_events
+        self.max_pending_bytes = max_pending_bytes
+        self.spool_size        = spool_size
+
+        self.events            = list()   # (method name, args, _Compression or None)
+        self.head              = 0
+        self.pending_bytes     = 0
+        self.depth             = 0
+
+        self.jobs              = Queue.Queue()
+        self.workers           = list()
+
+        if store is None:
+            return
+
+        self.pool = store.get_pool()
+
+        for i in range(num_workers):
+            t = threading.Thread( target = self._work )
+            t.daemon = True
+            t.start()
+            self.workers.append( t )
+
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            job.run( self.spool_size, self.store, self.pool )
+
+
+    def close(self):
+        for t in self.workers:
+            self.jobs.put( None )
+        for t in self.workers:
+            t.join()
+        self.workers = list()
+
+
+    def _full(self):
+        return len(self.events) - self.head >= self.max_events or \
+               self.pending_bytes >= self.max_pending_bytes
+
+
+    def _drain(self, wait_all = False):
+        while self.head < len(self.events):
+            name, args, job = self.events[ self.head ]
+
+            if job is not None:
+                if not job.done.is_set():
+                    if not (wait_all or self._full()):
+                        break
+                    job.done.wait()
+
+                self.pending_bytes -= job.fs_file.size
+
+                # On failure the writer retries inline and reports the
+                # error, if it persists, as it would without the pipeline
+                job.fs_file.compressed = job.data
+
+            self.events[ self.head ] = None
+            self.head += 1
+
+            getattr( self.delta, name )( *args )
+
+        if self.head == len(self.events):
+            self.events = list()
+            self.head   = 0
+        elif self.head > 1024 and self.head * 2 > len(self.events):
+            del self.events[ : self.head ]
+            self.head = 0
+
+
+    def _queue(self, name, args, job = None):
+        self.events.append( (name, args, job) )
+        self._drain()
+
+
+    def push_dir(self, dir_name):
+        self.depth += 1
+        self._queue( 'push_dir', (dir_name,) )
+
+    def pop_dir(self):
+        self.depth -= 1
+        self._queue( 'pop_dir', () )
+        if self.depth == 0:
+            self._drain( True )
+
+    def content_added(self, fs_file, force_zero_length = False):
+        job = None
+
+        if self.store is not None and fs_file.ftype == fs.REGULAR and not force_zero_length and \
+           fs_file.size > 0 and fs_file.nlink == 1 and not self.store.stores_inline( fs_file.size ):
+            job = _Compression( fs_file )
+            self.pending_bytes += fs_file.size
+            self.jobs.put( job )
+
+        self._queue( 'content_added', (fs_file, force_zero_length), job )
+
+    def content_removed(self, db_file):
+        self._queue( 'content_removed', (db_file,) )
+
+    def metadata_changed(self, db_file, fs_file):
+        self._queue( 'metadata_changed', (db_file, fs_file) )
+
+    def directory_removed(self, db_dir):
+        self._queue( 'directory_removed', (db_dir,) )
+
+    def directory_added(self, fs_dir):
+        self._queue( 'directory_added', (fs_dir,) )
+
+    def directory_scanned(self, fs_dir):
+        self._queue( 'directory_scanned', (fs_dir,) )
@@ -0,0 +1,1077 @@
+# SQLite backend
+#
+# Selected with BodyDB( db_dir, backend = 'sqlite' ). Databases are
+# reopened with the backend they were created with. Everything but the
+# file store lives in db_dir/kamino.sqlite:
+#
+#   entries       the current tree, one row per entry. Indexed by
+#                 (parent, name), by path, which stands in for the
+#                 ZODB path index, and by inode for stored files
+#   files         DBFiles, indexed by digest and by segment
+#   segments      store segments, plus retired segment numbers in retired
+#   mounts, inodes, links
+#                 the FileSystems
+#   patches, patch_dirs, patch_files, patch_meta
+#                 the PatchDatabase
+#
+# Scanner, DBUpdater, PatchCreator, Patcher and the compactor run
+# unchanged. They see the same types.* objects they see with ZODB: rows
+# are loaded into them on demand and each is given the _Session as its
+# _p_jar, so the persistent machinery reports attribute changes through
+# register() as it would to a ZODB Connection. Directory content and
+# the PatchedDirectory maps are replaced by mappings over the tables.
+#
+# Writes are queued and run with executemany. Statements on different
+# tables are independent, so a new row joins the latest batch of the
+# same statement unless another statement on its table came since.
+# Reads flush the queue of the table they read; commit() flushes
+# everything, then writes back changed objects.
+#
+# Loaded objects are only weakly referenced and mappings cache rows
+# rather than objects, so memory use does not grow with the size of the
+# tree.
+#
+import os.path
+import time
+import struct
+import weakref
+import sqlite3
+
+from kamino.body    import fs
+from kamino.body.db import types
+from kamino.body.db import file_store
+from kamino.body.db import codecs
+from kamino.body.db import BodyDB
+
+
+SQLITE_FILE = 'kamino.sqlite'
+
+# Version of the table layout
+SCHEMA = 1
+
+_tables = '''
+CREATE TABLE IF NOT EXISTS meta ( key TEXT PRIMARY KEY, value );
+
+CREATE TABLE IF NOT EXISTS entries ( id INTEGER PRIMARY KEY, parent INTEGER, path TEXT NOT NULL,
+    ftype INTEGER, name TEXT, uid INTEGER, gid INTEGER, mode INTEGER, mtime_ns INTEGER,
+    inode INTEGER, size INTEGER, fs_id INTEGER, file_id INTEGER, ctime_ns INTEGER,
+    target TEXT, major INTEGER, minor INTEGER, inline_codec TEXT, inline_data BLOB );
+CREATE UNIQUE INDEX IF NOT EXISTS entries_name ON entries ( parent, name );
+CREATE UNIQUE INDEX IF NOT EXISTS entries_path ON entries ( path );
+CREATE INDEX IF NOT EXISTS entries_inode ON entries ( fs_id, inode ) WHERE file_id IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS files ( file_id INTEGER PRIMARY KEY, segment INTEGER, offset INTEGER,
+    length INTEGER, zlength INTEGER, digest BLOB, chunks BLOB, codec TEXT, chunk_offsets BLOB );
+CREATE INDEX IF NOT EXISTS files_digest ON files ( digest );
+CREATE INDEX IF NOT EXISTS files_segment ON files ( segment );
+
+CREATE TABLE IF NOT EXISTS segments ( number INTEGER PRIMARY KEY, size INTEGER, live INTEGER );
+CREATE TABLE IF NOT EXISTS retired ( number INTEGER PRIMARY KEY );
+
+CREATE TABLE IF NOT EXISTS mounts ( mount_point TEXT PRIMARY KEY, fs_id INTEGER );
+CREATE TABLE IF NOT EXISTS inodes ( fs_id INTEGER, inode INTEGER, file_id INTEGER, count INTEGER,
+    PRIMARY KEY ( fs_id, inode ) );
+CREATE TABLE IF NOT EXISTS links ( fs_id INTEGER, inode INTEGER, path TEXT );
+CREATE INDEX IF NOT EXISTS links_inode ON links ( fs_id, inode );
+
+CREATE TABLE IF NOT EXISTS patches ( id INTEGER PRIMARY KEY, is_complete INTEGER,
+    starting_file_id INTEGER, ending_file_id INTEGER, uuid BLOB, previous_uuid BLOB, root INTEGER );
+CREATE TABLE IF NOT EXISTS patch_dirs ( id INTEGER PRIMARY KEY, patch INTEGER, parent INTEGER,
+    path TEXT, name TEXT, uid INTEGER, gid INTEGER, mode INTEGER, mtime_ns INTEGER, state INTEGER );
+CREATE UNIQUE INDEX IF NOT EXISTS patch_dirs_name ON patch_dirs ( parent, name );
+CREATE INDEX IF NOT EXISTS patch_dirs_patch ON patch_dirs ( patch );
+CREATE TABLE IF NOT EXISTS patch_files ( dir INTEGER, kind INTEGER,
+    ftype INTEGER, name TEXT, uid INTEGER, gid INTEGER, mode INTEGER, mtime_ns INTEGER,
+    inode INTEGER, size INTEGER, fs_id INTEGER, file_id INTEGER, ctime_ns INTEGER,
+    target TEXT, major INTEGER, minor INTEGER, inline_codec TEXT, inline_data BLOB,
+    PRIMARY KEY ( dir, kind, name ) );
+CREATE TABLE IF NOT EXISTS patch_meta ( dir INTEGER, name TEXT, to_uid INTEGER, to_gid INTEGER,
+    to_mode INTEGER, from_uid INTEGER, from_gid INTEGER, from_mode INTEGER, PRIMARY KEY ( dir, name ) );
+'''
+
+_meta_columns = 'ftype, name, uid, gid, mode, mtime_ns, inode, size, fs_id, file_id, ctime_ns, ' \
+                'target, major, minor, inline_codec, inline_data'
+
+_entry_select = 'SELECT id, parent, path, %s FROM entries WHERE ' % _meta_columns
+_entry_insert = 'INSERT OR REPLACE INTO entries ( id, parent, path, %s ) VALUES ( %s )' % (
+    _meta_columns, ', '.join( '?' * 19 ) )
+_entry_update = 'UPDATE entries SET %s WHERE id = ?' % ', '.join( '%s = ?' % c.strip()
+                                                                 for c in _meta_columns.split(',') )
+
+_file_columns = 'file_id, segment, offset, length, zlength, digest, chunks, codec, chunk_offsets'
+_file_select  = 'SELECT %s FROM files WHERE ' % _file_columns
+_file_insert  = 'INSERT OR REPLACE INTO files ( %s ) VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ? )' % _file_columns
+_file_update  = 'UPDATE files SET segment = ?, offset = ?, length = ?, zlength = ?, digest = ?, ' \
+                'chunks = ?, codec = ?, chunk_offsets = ? WHERE file_id = ?'
+
+_patch_select = 'SELECT id, is_complete, starting_file_id, ending_file_id, uuid, previous_uuid, root ' \
+                'FROM patches WHERE '
+
+_pdir_select  = 'SELECT id, patch, parent, path, name, uid, gid, mode, mtime_ns, state FROM patch_dirs WHERE '
+
+_pfile_select = 'SELECT dir, kind, %s FROM patch_files WHERE ' % _meta_columns
+
+# Keeps the file_id of an existing entry, as FileSystems.link_inode does
+_link_inode = 'INSERT OR REPLACE INTO inodes VALUES ( ?1, ?2, ' \
+              'COALESCE( ( SELECT file_id FROM inodes WHERE fs_id = ?1 AND inode = ?2 ), ?3 ), ' \
+              '1 + COALESCE( ( SELECT count FROM inodes WHERE fs_id = ?1 AND inode = ?2 ), 0 ) )'
+
+# Records the paths of a file first scanned with a single link, as
+# FileSystems.link_inode does from the File it references
+_link_backfill = 'INSERT INTO links SELECT ?1, ?2, path FROM entries WHERE fs_id = ?1 AND inode = ?2 ' \
+                 'AND file_id IS NOT NULL AND path != ?3 ' \
+                 'AND NOT EXISTS ( SELECT 1 FROM links WHERE fs_id = ?1 AND inode = ?2 )'
+
+# patch_files.kind
+ADDS    = 0
+REMOVES = 1
+
+_classes = { fs.DIRECTORY : types.Directory,
+             fs.REGULAR   : types.File,
+             fs.SYMLINK   : types.Symlink,
+             fs.SOCKET    : types.Socket,
+             fs.FIFO      : types.Fifo,
+             fs.BLOCKDEV  : types.BlockDev,
+             fs.CHARDEV   : types.CharDev }
+
+
+# Inode numbers are unsigned 64-bit; SQLite integers are signed
+def _signed( i ):
+    return i - (1 << 64) if i is not None and i >= (1 << 63) else i
+
+def _unsigned( i ):
+    return i + (1 << 64) if i is not None and i < 0 else i
+
+
+def _blob( s ):
+    return None if s is None else sqlite3.Binary( s )
+
+def _str( b ):
+    return None if b is None else str( b )
+
+
+def _pack( ids ):
+    return None if ids is None else sqlite3.Binary( struct.pack( '<%dq' % len(ids), *ids ) )
+
+def _unpack( b ):
+    return None if b is None else struct.unpack( '<%dq' % (len(b) / 8), str(b) )
+
+
+def _meta_row( o ):
+    g      = getattr
+    inline = g( o, 'inline', None ) or (None, None)
+    return ( o.ftype, o.name, o.uid, o.gid, o.mode, o.mtime_ns,
+             _signed( g( o, 'inode', None ) ), g( o, 'size', None ), g( o, 'fs_id', None ),
+             g( o, 'file_id', None ), g( o, 'ctime_ns', None ), g( o, 'target', None ),
+             g( o, 'dev_major', g( o, 'major', None ) ), g( o, 'dev_minor', g( o, 'minor', None ) ),
+             inline[0], _blob( inline[1] ) )
+
+
+# 'row' holds the _meta_columns
+def _load_meta( row, parent, fq_name ):
+    ftype, name, uid, gid, mode, mtime_ns, inode, size, fs_id, file_id, ctime_ns, \
+        target, major, minor, inline_codec, inline_data = row
+
+    cls = _classes[ ftype ]
+    o   = cls.__new__( cls )
+
+    o.name     = name
+    o.parent   = parent
+    o.uid      = uid
+    o.gid      = gid
+    o.mode     = mode
+    o.mtime_ns = mtime_ns
+    o.fq_name  = fq_name
+
+    if ftype == fs.REGULAR:
+        o.inode   = _unsigned( inode )
+        o.size    = size
+        o.fs_id   = fs_id
+        o.file_id = file_id
+        if inline_codec is not None:
+            o.inline = (inline_codec, str(inline_data))
+
+    elif ftype == fs.DIRECTORY:
+        if inode is not None:
+            o.inode    = _unsigned( inode )
+            o.ctime_ns = ctime_ns
+
+    elif ftype == fs.SYMLINK:
+        o.target = target
+
+    elif ftype in (fs.BLOCKDEV, fs.CHARDEV):
+        o.major = o.dev_major = major
+        o.minor = o.dev_minor = minor
+
+    return o
+
+
+
+class _Session (object):
+
+    # Stands in for the ZODB Connection as the _p_jar of loaded objects
+
+    def __init__(self, con):
+        self.con     = con
+        self.pending = list() # [table, sql, rows], in execution order
+        self.dirty   = list()
+        self.savers  = dict() # table => function( obj, key ) returning (sql, args)
+
+
+    def queue(self, table, sql, row):
+        for batch in reversed( self.pending ):
+            if batch[1] == sql:
+                batch[2].append( row )
+                return
+            if batch[0] == table:
+                break
+        self.pending.append( [table, sql, [row]] )
+
+
+    # Runs the queued statements of 'table', or every queued statement and
+    # the updates of changed objects
+    def flush(self, table = None):
+        if table is None:
+            batches, self.pending = self.pending, list()
+        else:
+            batches      = [ b for b in self.pending if b[0] == table ]
+            self.pending = [ b for b in self.pending if b[0] != table ]
+
+        for t, sql, rows in batches:
+            self.con.executemany( sql, rows )
+
+        if table is None and self.dirty:
+            dirty, self.dirty = self.dirty, list()
+            updates = dict()
+            for obj in dirty:
+                t, key    = obj._p_oid
+                sql, args = self.savers[ t ]( obj, key )
+                updates.setdefault( sql, list() ).append( args )
+                obj._p_changed = False
+            for sql, rows in updates.iteritems():
+                self.con.executemany( sql, rows )
+
+
+    def query(self, table, sql, args = ()):
+        for b in self.pending:
+            if b[0] == table:
+                self.flush( table )
+                break
+        return self.con.execute( sql, args )
+
+
+    def attach(self, obj, table, key):
+        obj._p_oid = (table, key)
+        obj._p_jar = self
+
+    # Persistent jar protocol
+    def register(self, obj):
+        self.dirty.append( obj )
+
+    def setstate(self, obj):
+        pass
+
+
+
+class _Rows (object):
+
+    # Mapping over the child rows of one record. The rows, keyed by name,
+    # are read on first use. 'new' records have none
+
+    def __init__(self, db, new):
+        self.db   = db
+        self.rows = dict() if new else None
+
+    def _rows(self):
+        if self.rows is None:
+            self.rows = dict( self._read() )
+        return self.rows
+
+    def get(self, name, default = None):
+        r = self._rows().get( name )
+        return default if r is None else self._object( r )
+
+    def __getitem__(self, name):
+        return self._object( self._rows()[ name ] )
+
+    def __contains__(self, name):
+        return name in self._rows()
+
+    has_key = __contains__
+
+    def __len__(self):
+        return len( self._rows() )
+
+    def __nonzero__(self):
+        return bool( self._rows() )
+
+    def keys(self):
+        return sorted( self._rows() )
+
+    def __iter__(self):
+        return iter( self.keys() )
+
+    iterkeys = __iter__
+
+    def items(self):
+        rows = self._rows()
+        return [ (k, self._object( rows[k] )) for k in sorted( rows ) ]
+
+    def iteritems(self):
+        return iter( self.items() )
+
+    def values(self):
+        return [ v for k, v in self.items() ]
+
+    def itervalues(self):
+        return iter( self.values() )
+
+
+
+class _Content (_Rows):
+
+    def __init__(self, db, owner, eid, new = False):
+        _Rows.__init__( self, db, new )
+        self.owner = owner
+        self.eid   = eid
+
+    def _read(self):
+        for r in self.db.session.query( 'entries', _entry_select + 'parent = ?', (self.eid,) ):
+            yield r[4], r
+
+    def _object(self, row):
+        return self.db._entry( row, self.owner )
+
+    def __setitem__(self, name, v):
+        self._rows()[ name ] = self.db._insert_entry( v, self.eid )
+
+    # Removes the entry and, for directories, everything below it
+    def __delitem__(self, name):
+        path = self._rows().pop( name )[2]
+        self.db.session.queue( 'entries', 'DELETE FROM entries WHERE path = ? OR (path > ? AND path < ?)',
+                               (path, path + '/', path + '0') )
+
+
+
+class _PatchFiles (_Rows):
+
+    def __init__(self, db, owner, pid, kind, new = False):
+        _Rows.__init__( self, db, new )
+        self.owner = owner
+        self.pid   = pid
+        self.kind  = kind
+
+    def _read(self):
+        for r in self.db.session.query( 'patch_files', _pfile_select + 'dir = ? AND kind = ?',
+                                        (self.pid, self.kind) ):
+            yield r[3], r
+
+    def _object(self, row):
+        return _load_meta( row[2:], self.owner, self.owner.get_fq_name() + '/' + row[3] )
+
+    def __setitem__(self, name, v):
+        row = (self.pid, self.kind) + _meta_row( v )
+        self.db.session.queue( 'patch_files', 'INSERT OR REPLACE INTO patch_files VALUES ( %s )' %
+                               ', '.join( '?' * 18 ), row )
+        self._rows()[ name ] = row
+
+    def __delitem__(self, name):
+        del self._rows()[ name ]
+        self.db.session.queue( 'patch_files', 'DELETE FROM patch_files WHERE dir = ? AND kind = ? AND name = ?',
+                               (self.pid, self.kind, name) )
+
+
+
+class _PatchMeta (_Rows):
+
+    def __init__(self, db, pid, new = False):
+        _Rows.__init__( self, db, new )
+        self.pid = pid
+
+    def _read(self):
+        for r in self.db.session.query( 'patch_meta', 'SELECT * FROM patch_meta WHERE dir = ?', (self.pid,) ):
+            yield r[1], r
+
+    def _object(self, row):
+        return (tuple( row[2:5] ), tuple( row[5:8] ))
+
+    def __setitem__(self, name, v):
+        row = (self.pid, name) + tuple( v[0] ) + tuple( v[1] )
+        self.db.session.queue( 'patch_meta', 'INSERT OR REPLACE INTO patch_meta VALUES ( ?, ?, ?, ?, ?, ?, ?, ? )',
+                               row )
+        self._rows()[ name ] = row
+
+
+
+class _PatchSubdirs (_Rows):
+
+    def __init__(self, db, owner, pid, patch, new = False):
+        _Rows.__init__( self, db, new )
+        self.owner = owner
+        self.pid   = pid
+        self.patch = patch
+
+    def _read(self):
+        for r in self.db.session.query( 'patch_dirs', _pdir_select + 'parent = ?', (self.pid,) ):
+            yield r[4], r
+
+    def _object(self, row):
+        return self.db._patch_dir( row, self.owner )
+
+    def __setitem__(self, name, v):
+        self._rows()[ name ] = self.db._insert_patch_dir( v, self.patch, self.pid )
+
+
+
+class _Files (object):
+
+    def __init__(self, db):
+        self.db     = db
+        self.loaded = weakref.WeakValueDictionary()
+
+    def _load(self, row):
+        o = self.loaded.get( row[0] )
+        if o is not None:
+            return o
+
+        o = types.DBFile.__new__( types.DBFile )
+
+        o.file_id, o.segment, o.offset, o.length, o.zlength, digest, chunks, o.codec, offsets = row
+
+        o.digest        = _str( digest )
+        o.chunks        = _unpack( chunks )
+        o.chunk_offsets = _unpack( offsets )
+
+        self.db.session.attach( o, 'files', o.file_id )
+        self.loaded[ o.file_id ] = o
+        return o
+
+    def get(self, file_id, default = None):
+        o = self.loaded.get( file_id )
+        if o is None:
+            row = self.db.session.query( 'files', _file_select + 'file_id = ?', (file_id,) ).fetchone()
+            if row is None:
+                return default
+            o = self._load( row )
+        return o
+
+    def __getitem__(self, file_id):
+        o = self.get( file_id )
+        if o is None:
+            raise KeyError( file_id )
+        return o
+
+    def __contains__(self, file_id):
+        return self.get( file_id ) is not None
+
+    has_key = __contains__
+
+    def __setitem__(self, file_id, dbf):
+        self.db.session.queue( 'files', _file_insert, _file_row( dbf ) )
+        self.db.session.attach( dbf, 'files', file_id )
+        self.loaded[ file_id ] = dbf
+
+    def __delitem__(self, file_id):
+        self.loaded.pop( file_id, None )
+        self.db.session.queue( 'files', 'DELETE FROM files WHERE file_id = ?', (file_id,) )
+
+    def __len__(self):
+        return self.db.session.query( 'files', 'SELECT COUNT(*) FROM files' ).fetchone()[0]
+
+    # In file_id order, inclusive. Whole tables are read in slices so that
+    # neither the rows nor the cursor outlive a batch of changes
+    def values(self, min = None, max = None):
+        return list( self.itervalues( min, max ) )
+
+    def itervalues(self, min = None, max = None):
+        last = (1 if min is None else min) - 1 # file_ids start at 1
+        while True:
+            where = 'file_id > ?' + ('' if max is None else ' AND file_id <= %d' % max)
+            rows  = self.db.session.query( 'files', _file_select + where + ' ORDER BY file_id LIMIT 1000',
+                                           (last,) ).fetchall()
+            if not rows:
+                return
+            for r in rows:
+                yield self._load( r )
+            last = rows[-1][0]
+
+    def iteritems(self):
+        for o in self.itervalues():
+            yield o.file_id, o
+
+
+def _file_row( dbf ):
+    return ( dbf.file_id, dbf.segment, dbf.offset, dbf.length, dbf.zlength, _blob( dbf.digest ),
+             _pack( dbf.chunks ), dbf.codec, _pack( dbf.chunk_offsets ) )
+
+
+
+class _Segments (object):
+
+    # Few enough to keep loaded
+
+    def __init__(self, db):
+        self.db   = db
+        self.segs = dict()
+
+        for n, size, live in db.con.execute( 'SELECT number, size, live FROM segments' ):
+            s = types.Segment.__new__( types.Segment )
+            s.number, s.size, s.live = n, size, live
+            db.session.attach( s, 'segments', n )
+            self.segs[ n ] = s
+
+    def __getitem__(self, n):
+        return self.segs[ n ]
+
+    def get(self, n, default = None):
+        return self.segs.get( n, default )
+
+    def __contains__(self, n):
+        return n in self.segs
+
+    def __len__(self):
+        return len( self.segs )
+
+    def __setitem__(self, n, s):
+        self.db.session.queue( 'segments', 'INSERT OR REPLACE INTO segments VALUES ( ?, ?, ? )',
+                               (n, s.size, s.live) )
+        self.db.session.attach( s, 'segments', n )
+        self.segs[ n ] = s
+
+    def __delitem__(self, n):
+        del self.segs[ n ]
+        self.db.session.queue( 'segments', 'DELETE FROM segments WHERE number = ?', (n,) )
+
+    def maxKey(self):
+        return max( self.segs )
+
+    def keys(self):
+        return sorted( self.segs )
+
+    def items(self):
+        return [ (n, self.segs[n]) for n in self.keys() ]
+
+    def values(self):
+        return [ self.segs[n] for n in self.keys() ]
+
+    def iteritems(self):
+        return iter( self.items() )
+
+    def itervalues(self):
+        return iter( self.values() )
+
+
+
+class _Retired (object):
+
+    def __init__(self, db):
+        self.db      = db
+        self.numbers = [ r[0] for r in db.con.execute( 'SELECT number FROM retired ORDER BY number' ) ]
+
+    def __iter__(self):
+        return iter( list( self.numbers ) )
+
+    def __len__(self):
+        return len( self.numbers )
+
+    def append(self, n):
+        self.numbers.append( n )
+        self.db.session.queue( 'retired', 'INSERT OR REPLACE INTO retired VALUES ( ? )', (n,) )
+
+    def __delitem__(self, i):
+        removed = self.numbers[ i ]
+        del self.numbers[ i ]
+        for n in (removed if isinstance( i, slice ) else [removed]):
+            self.db.session.queue( 'retired', 'DELETE FROM retired WHERE number = ?', (n,) )
+
+
+
+class _FileDatabase (types.FileDatabase):
+
+    def __init__(self, db):
+        self.db              = db
+        self.next_file_id    = db.meta['next_file_id']
+        self.current_segment = db.meta['current_segment']
+        self.files           = _Files( db )
+        self.segments        = _Segments( db )
+        self.retired         = _Retired( db )
+        self.recent          = dict() # digest => DBFile added since the last commit
+
+
+    def find_content(self, digest, length):
+        dbf = self.recent.get( digest )
+
+        if dbf is None:
+            # New rows are in 'recent', so the queued ones need not be
+            # written first
+            row = self.db.con.execute( 'SELECT file_id FROM files WHERE digest = ? AND length = ? LIMIT 1',
+                                       (_blob( digest ), length) ).fetchone()
+            if row is not None:
+                dbf = self.files.get( row[0] )
+
+        if dbf is not None and dbf.length == length:
+            return dbf.file_id
+
+        return None
+
+    def index_content(self, file_id, digest):
+        if not digest in self.recent:
+            self.recent[ digest ] = self.files[ file_id ]
+
+    def unindex_content(self, file_id, digest):
+        dbf = self.recent.get( digest )
+        if dbf is not None and dbf.file_id == file_id:
+            del self.recent[ digest ]
+
+
+
+class _FileSystems (types.FileSystems):
+
+    def __init__(self, db):
+        self.db         = db
+        self.next_fs_id = db.meta['next_fs_id']
+        self.mounts     = dict( db.con.execute( 'SELECT mount_point, fs_id FROM mounts' ) )
+
+
+    # Committed at once, as with ZODB
+    def add_mount(self, mount_point):
+        i = self.next_fs_id
+        self.next_fs_id += 1
+
+        self.mounts[ mount_point ] = i
+        self.db.session.queue( 'mounts', 'INSERT OR REPLACE INTO mounts VALUES ( ?, ? )', (mount_point, i) )
+
+        self.db.commit( True )
+
+
+    # The entries table stands in for the File reference kept for inodes
+    # with a single link
+    def link_inode(self, fs_id, inode, file_id, path, nlink = 1, db_file = None):
+        inode = _signed( inode )
+
+        self.db.session.queue( 'inodes', _link_inode, (fs_id, inode, file_id) )
+
+        if nlink > 1:
+            self.db.session.queue( 'links', _link_backfill, (fs_id, inode, path) )
+            self.db.session.queue( 'links', 'INSERT INTO links VALUES ( ?, ?, ? )', (fs_id, inode, path) )
+
+
+    def unlink_inode(self, fs_id, inode, path):
+        inode = _signed( inode )
+        q     = self.db.session.queue
+
+        q( 'inodes', 'UPDATE inodes SET count = count - 1 WHERE fs_id = ? AND inode = ?', (fs_id, inode) )
+        q( 'inodes', 'DELETE FROM inodes WHERE fs_id = ? AND inode = ? AND count <= 0', (fs_id, inode) )
+        q( 'links',  'DELETE FROM links WHERE fs_id = ? AND inode = ? AND path = ?', (fs_id, inode, path) )
+
+
+    def get_inode_file_id(self, fs_id, inode):
+        row = self.db.session.query( 'inodes', 'SELECT file_id FROM inodes WHERE fs_id = ? AND inode = ?',
+                                     (fs_id, _signed( inode )) ).fetchone()
+        return None if row is None else row[0]
+
+
+    def get_inode_paths(self, fs_id, inode):
+        return [ r[0] for r in self.db.session.query( 'links', 'SELECT path FROM links WHERE fs_id = ? AND '
+                                                      'inode = ? ORDER BY rowid', (fs_id, _signed( inode )) ) ]
+
+
+    def inode_report(self):
+        q       = self.db.session.query
+        ninodes = q( 'inodes', 'SELECT COUNT(*) FROM inodes' ).fetchone()[0]
+        nlinked, npaths = q( 'links', 'SELECT COUNT(DISTINCT fs_id || \':\' || inode), COUNT(*) FROM links' ).fetchone()
+        return '%d inodes, %d with multiple links holding %d paths' % (ninodes, nlinked, npaths)
+
+
+
+class _Patches (object):
+
+    # Patches are few and small, so loaded ones are kept
+
+    def __init__(self, db):
+        self.db     = db
+        self.loaded = dict()
+
+    def _load(self, row):
+        p = types.Patch.__new__( types.Patch )
+
+        n, is_complete, p.starting_file_id, p.ending_file_id, uuid, previous_uuid, root = row
+
+        p.id_number     = n
+        p.is_complete   = bool( is_complete )
+        p.uuid          = _str( uuid )
+        p.previous_uuid = _str( previous_uuid )
+        p.root          = self.db._get_patch_dir( root )
+
+        self.db.session.attach( p, 'patches', n )
+        self.loaded[ n ] = p
+        return p
+
+    def get(self, n, default = None):
+        p = self.loaded.get( n )
+        if p is None:
+            row = self.db.session.query( 'patches', _patch_select + 'id = ?', (n,) ).fetchone()
+            if row is None:
+                return default
+            p = self._load( row )
+        return p
+
+    def __getitem__(self, n):
+        p = self.get( n )
+        if p is None:
+            raise KeyError( n )
+        return p
+
+    def __contains__(self, n):
+        return self.get( n ) is not None
+
+    has_key = __contains__
+
+    def __len__(self):
+        return self.db.session.query( 'patches', 'SELECT COUNT(*) FROM patches' ).fetchone()[0]
+
+    def keys(self, min = None, max = None):
+        sql  = 'SELECT id FROM patches WHERE id >= ? AND id <= ? ORDER BY id'
+        args = (-1 << 63 if min is None else min, (1 << 63) - 1 if max is None else max)
+        return [ r[0] for r in self.db.session.query( 'patches', sql, args ) ]
+
+    def values(self):
+        return [ self[n] for n in self.keys() ]
+
+    def itervalues(self):
+        return iter( self.values() )
+
+    def items(self):
+        return [ (n, self[n]) for n in self.keys() ]
+
+    def iteritems(self):
+        return iter( self.items() )
+
+    def __setitem__(self, n, p):
+        root = self.db._insert_patch_dir( p.root, n, None )[0]
+
+        self.db.session.queue( 'patches', 'INSERT OR REPLACE INTO patches VALUES ( ?, ?, ?, ?, ?, ?, ? )',
+                               _patch_row( p ) + (root,) )
+        self.db.session.attach( p, 'patches', n )
+        self.loaded[ n ] = p
+
+    # Everything queued is written first, as the deletes span tables
+    def __delitem__(self, n):
+        self.loaded.pop( n, None )
+        self.db.session.flush()
+
+        ex = self.db.con.execute
+        ex( 'DELETE FROM patch_files WHERE dir IN ( SELECT id FROM patch_dirs WHERE patch = ? )', (n,) )
+        ex( 'DELETE FROM patch_meta WHERE dir IN ( SELECT id FROM patch_dirs WHERE patch = ? )', (n,) )
+        ex( 'DELETE FROM patch_dirs WHERE patch = ?', (n,) )
+        ex( 'DELETE FROM patches WHERE id = ?', (n,) )
+
+
+def _patch_row( p ):
+    return ( p.id_number, p.is_complete, p.starting_file_id, p.ending_file_id,
+             _blob( p.uuid ), _blob( p.previous_uuid ) )
+
+
+
+class _PatchDatabase (types.PatchDatabase):
+
+    def __init__(self, db):
+        self.db                 = db
+        self.last_patch_id      = db.meta['last_patch_id']
+        self.last_patch_file_id = db.meta['last_patch_file_id']
+        self.patches            = _Patches( db )
+
+
+
+class SqliteBodyDB (BodyDB):
+
+    # The arguments are those of BodyDB, which hands sqlite databases over
+    # to this class. cache_size is in pages.
+    #
+    # read_only instances are readers: each reads inside one transaction,
+    # which WAL keeps at the last commit before it began, whatever the
+    # writer commits meanwhile. See refresh(). They may be handed to
+    # another thread, but only be used by one thread at a time
+    def __init__(self, db_dir, read_only=False, codec=codecs.DEFAULT,
+                 inline_threshold=file_store.INLINE_THRESHOLD, backend=None, cache_size=None):
+        self.db_dir        = db_dir
+        self.sqlite_file   = os.path.join(db_dir, SQLITE_FILE)
+        self.file_store_fn = os.path.join(db_dir, 'file_store')
+        self.journal_fn    = os.path.join(db_dir, 'journal')
+        self.read_only     = read_only
+
+        if read_only and not os.path.exists( self.sqlite_file ):
+            raise Exception('Database %s has not been initialized' % db_dir)
+
+        self.codec            = codec
+        self.inline_threshold = inline_threshold
+        self.cache_size       = cache_size
+
+        self.con = sqlite3.connect( self.sqlite_file, timeout = 60, check_same_thread = not read_only )
+        self.con.text_factory = str
+
+        if cache_size is not None:
+            self.con.execute( 'PRAGMA cache_size = %d' % cache_size )
+
+        if read_only:
+            self.con.execute( 'PRAGMA query_only = ON' )
+            self.con.isolation_level = None
+            self.con.execute( 'BEGIN' )
+        else:
+            # Readers see the last commit while a scan writes
+            self.con.execute( 'PRAGMA journal_mode = WAL' )
+            self.con.execute( 'PRAGMA synchronous = NORMAL' )
+            self._create()
+
+        self._load()
+
+        # Commit policy for scans. See BodyDB.commit()
+        self.commit_ops     = 1000
+        self.commit_seconds = 5.0
+        self.commit_at_dirs = True # Also commit as each directory is completed
+        self.pending_ops    = 0
+        self.last_commit    = time.time()
+
+        if not read_only:
+            self.fs_db.check_filesystems()
+
+        # Paths are looked up through the entries table instead
+        self.path_index = None
+
+
+    def _load(self):
+        self.meta = dict( self.con.execute( 'SELECT key, value FROM meta' ) )
+
+        if self.meta.get('format', 0) > SCHEMA:
+            raise Exception('Database %s is newer than this version of kamino' % self.db_dir)
+
+        self.session = _Session( self.con )
+        self.session.savers.update( entries    = self._save_entry,
+                                    files      = self._save_file,
+                                    segments   = self._save_segment,
+                                    patches    = self._save_patch,
+                                    patch_dirs = self._save_patch_dir )
+
+        self.entries    = weakref.WeakValueDictionary() # id => loaded entry
+        self.patch_dirs = weakref.WeakValueDictionary() # id => loaded PatchedDirectory
+
+        self.next_entry_id     = self.meta['next_entry_id']
+        self.next_patch_dir_id = self.meta['next_patch_dir_id']
+
+        self.db_root  = { '/' : self._get_entry( 1 ) }
+
+        self.fs_db    = _FileSystems( self )
+        self.file_db  = _FileDatabase( self )
+        self.patch_db = _PatchDatabase( self )
+
+        self.file_store = file_store.FileStore( self.file_store_fn, self, self.read_only, self.codec,
+                                                self.inline_threshold )
+
+
+    def open_reader(self, cache_size=None):
+        return SqliteBodyDB( self.db_dir, True, self.codec, self.inline_threshold,
+                             cache_size = self.cache_size if cache_size is None else cache_size )
+
+
+    # Moves a reader's view up to the latest commit. Objects obtained
+    # before are left behind
+    def refresh(self):
+        self.con.execute( 'COMMIT' )
+        self.con.execute( 'BEGIN' )
+        self.file_store.close()
+        self._load()
+
+
+    def close(self):
+        self.file_store.close()
+        self.con.close()
+
+
+    # SQLite opens need no index rebuild. Committing is all that is needed
+    # for other connections to see the current state
+    def save_index(self):
+        self.commit( True )
+
+
+    def _create(self):
+        self.con.executescript( _tables )
+
+        if self.con.execute( 'SELECT COUNT(*) FROM meta' ).fetchone()[0]:
+            return
+
+        root = types.Directory( '', None, 0, 0, 0755, 0 )
+
+        self.con.execute( _entry_insert, (1, None, '') + _meta_row( root ) )
+        self.con.execute( 'INSERT INTO segments VALUES ( 0, 0, 0 )' )
+        self.con.executemany( 'INSERT INTO meta VALUES ( ?, ? )',
+                              [ ('format', SCHEMA), ('next_entry_id', 2), ('next_patch_dir_id', 1),
+                                ('next_file_id', 1), ('current_segment', 0), ('next_fs_id', 1),
+                                ('last_patch_id', None), ('last_patch_file_id', None) ] )
+        self.con.commit()
+
+
+    def _commit_transaction(self):
+        self.file_db.recent = dict()
+
+        self.session.flush()
+
+        self.con.executemany( 'INSERT OR REPLACE INTO meta VALUES ( ?, ? )',
+                              [ ('next_entry_id',      self.next_entry_id),
+                                ('next_patch_dir_id',  self.next_patch_dir_id),
+                                ('next_file_id',       self.file_db.next_file_id),
+                                ('current_segment',    self.file_db.current_segment),
+                                ('next_fs_id',         self.fs_db.next_fs_id),
+                                ('last_patch_id',      self.patch_db.last_patch_id),
+                                ('last_patch_file_id', self.patch_db.last_patch_file_id) ] )
+        self.con.commit()
+
+
+    def lookup(self, path):
+        path = path.strip('/')
+
+        if not path:
+            return self.db_root['/']
+
+        row = self.session.query( 'entries', _entry_select + 'path = ?', ('/' + path,) ).fetchone()
+
+        return None if row is None else self._entry( row )
+
+
+    #------------------------------------------------------------------
+    # Entries of the current tree
+
+    def _entry(self, row, parent = None):
+        o = self.entries.get( row[0] )
+        if o is not None:
+            return o
+
+        if parent is None and row[1] is not None:
+            parent = self._get_entry( row[1] )
+
+        o = _load_meta( row[3:], parent, row[2] )
+
+        if o.ftype == fs.DIRECTORY:
+            o.content = _Content( self, o, row[0] )
+
+        self.session.attach( o, 'entries', row[0] )
+        self.entries[ row[0] ] = o
+        return o
+
+    def _get_entry(self, eid):
+        o = self.entries.get( eid )
+        if o is None:
+            row = self.session.query( 'entries', _entry_select + 'id = ?', (eid,) ).fetchone()
+            if row is not None:
+                o = self._entry( row )
+        return o
+
+    # Returns the new row
+    def _insert_entry(self, o, parent_id):
+        eid = self.next_entry_id
+        self.next_entry_id += 1
+
+        row = (eid, parent_id, o.get_fq_name()) + _meta_row( o )
+        self.session.queue( 'entries', _entry_insert, row )
+
+        if o.ftype == fs.DIRECTORY:
+            old       = o.content
+            o.content = _Content( self, o, eid, True )
+            for k, v in old.items():
+                o.content[ k ] = v
+
+        self.session.attach( o, 'entries', eid )
+        self.entries[ eid ] = o
+        return row
+
+    def _save_entry(self, o, eid):
+        meta = _meta_row( o )
+
+        # Keep the parent's cached row current
+        if o.parent is not None:
+            rows = o.parent.content.rows
+            if rows is not None and o.name in rows and rows[ o.name ][0] == eid:
+                rows[ o.name ] = rows[ o.name ][:3] + meta
+
+        return _entry_update, meta + (eid,)
+
+
+    #------------------------------------------------------------------
+    # PatchedDirectories
+
+    def _patch_dir(self, row, parent = None):
+        o = self.patch_dirs.get( row[0] )
+        if o is not None:
+            return o
+
+        if parent is None and row[2] is not None:
+            parent = self._get_patch_dir( row[2] )
+
+        o = types.PatchedDirectory.__new__( types.PatchedDirectory )
+
+        pid, patch, _, o.fq_name, o.name, o.uid, o.gid, o.mode, o.mtime_ns, o.state = row
+
+        o.parent = parent
+        self._patch_maps( o, pid, patch, False )
+
+        self.session.attach( o, 'patch_dirs', pid )
+        self.patch_dirs[ pid ] = o
+        return o
+
+    def _get_patch_dir(self, pid):
+        o = self.patch_dirs.get( pid )
+        if o is None:
+            row = self.session.query( 'patch_dirs', _pdir_select + 'id = ?', (pid,) ).fetchone()
+            if row is not None:
+                o = self._patch_dir( row )
+        return o
+
+    def _patch_maps(self, o, pid, patch, new):
+        o.adds         = _PatchFiles( self, o, pid, ADDS, new )
+        o.removes      = _PatchFiles( self, o, pid, REMOVES, new )
+        o.meta_changes = _PatchMeta( self, pid, new )
+        o.subdirs      = _PatchSubdirs( self, o, pid, patch, new )
+
+    # Anything already in the directory's maps is inserted along with it.
+    # Returns the new row
+    def _insert_patch_dir(self, o, patch, parent_id):
+        pid = self.next_patch_dir_id
+        self.next_patch_dir_id += 1
+
+        row = (pid, patch, parent_id, o.get_fq_name(), o.name, o.uid, o.gid, o.mode, o.mtime_ns, o.state)
+        self.session.queue( 'patch_dirs', 'INSERT OR REPLACE INTO patch_dirs VALUES ( %s )' %
+                            ', '.join( '?' * 10 ), row )
+
+        old = (o.adds, o.removes, o.meta_changes, o.subdirs)
+
+        self._patch_maps( o, pid, patch, True )
+
+        for src, dst in zip( old, (o.adds, o.removes, o.meta_changes, o.subdirs) ):
+            for k, v in src.items():
+                dst[ k ] = v
+
+        self.session.attach( o, 'patch_dirs', pid )
+        self.patch_dirs[ pid ] = o
+        return row
+
+    def _save_patch_dir(self, o, pid):
+        if o.parent is not None:
+            rows = o.parent.subdirs.rows
+            if rows is not None and o.name in rows and rows[ o.name ][0] == pid:
+                rows[ o.name ] = rows[ o.name ][:5] + (o.uid, o.gid, o.mode, o.mtime_ns, o.state)
+
+        return 'UPDATE patch_dirs SET uid = ?, gid = ?, mode = ?, mtime_ns = ?, state = ? WHERE id = ?', \
+               (o.uid, o.gid, o.mode, o.mtime_ns, o.state, pid)
+
+
+    #------------------------------------------------------------------
+    # Other records
+
+    def _save_file(self, dbf, file_id):
+        return _file_update, _file_row( dbf )[1:] + (file_id,)
+
+    def _save_segment(self, s, n):
+        return 'UPDATE segments SET size = ?, live = ? WHERE number = ?', (s.size, s.live, n)
+
+    def _save_patch(self, p, n):
+        return 'UPDATE patches SET is_complete = ?, starting_file_id = ?, ending_file_id = ?, uuid = ?, ' \
+               'previous_uuid = ? WHERE id = ?', _patch_row( p )[1:] + (n,)
@@ -4,6 +4,8 @@ from persistent         import Persistent
 from persistent.mapping import PersistentMapping
 from persistent.list    import PersistentList
 from BTrees.IOBTree     import IOBTree
+from BTrees.OOBTree     import OOBTree
+from BTrees.LOBTree     import LOBTree
 
 
 from kamino.body import fs
@@ -11,6 +13,9 @@ from kamino.body import fs
 
 
 class FileMeta (Persistent):
+
+    fq_name = None # Set on creation. Records that predate it walk their parents
+    
     def __init__(self, name, parent, uid, gid, mode, mtime_ns):
         self.name     = name
         self.parent   = parent
@@ -18,8 +23,12 @@ class FileMeta (Persistent):
         self.gid      = gid
         self.mode     = mode   # Must have file type bits masked off
         self.mtime_ns = mtime_ns
+        self.fq_name  = name if parent is None else parent.get_fq_name() + '/' + name
 
     def get_fq_name(self):
+        if self.fq_name is not None:
+            return self.fq_name
+        
         l = [self.name,]
         p = self.parent
         while p:
@@ -37,11 +46,40 @@ class FileMeta (Persistent):
 class Directory (FileMeta):
 
     ftype = fs.DIRECTORY
+
+    # Recorded by record_stat() once the directory's listing has been
+    # fully processed. Class-level defaults cover databases created
+    # before these were tracked
+    inode    = None
+    ctime_ns = None
     
     def __init__(self, name, parent, uid, gid, mode, mtime_ns):
         FileMeta.__init__(self, name, parent, uid, gid, mode, mtime_ns)
-        
-        self.content = PersistentMapping()
+
+        # A BTree, so that changing one entry of a large directory only
+        # rewrites the bucket holding it
+        self.content = OOBTree()
+
+
+    # Databases created before BTree directories hold content in a
+    # PersistentMapping. Returns True if it was converted
+    def convert_content(self):
+        if isinstance( self.content, OOBTree ):
+            return False
+        self.content = OOBTree( dict( self.content ) )
+        return True
+
+
+    def record_stat(self, fs_dir):
+        self.inode    = fs_dir.inode
+        self.mtime_ns = fs_dir.mtime_ns
+        self.ctime_ns = fs_dir.ctime_ns
+
+    # True if the directory's listing cannot have changed since the last
+    # call to record_stat()
+    def stat_matches(self, fs_dir):
+        return self.inode is not None and (self.inode, self.mtime_ns, self.ctime_ns) == (
+            fs_dir.inode, fs_dir.mtime_ns, fs_dir.ctime_ns)
 
 
     def get_content_set(self):
@@ -60,6 +98,10 @@ class Directory (FileMeta):
 class File (FileMeta):
 
     ftype = fs.REGULAR
+
+    # (codec, data) of content small enough to be kept in the record
+    # itself rather than in the file store. file_id is then None
+    inline = None
     
     def __init__(self, name, parent, uid, gid, mode, mtime_ns):
         FileMeta.__init__(self, name, parent, uid, gid, mode, mtime_ns)
@@ -140,15 +182,53 @@ class CharDev (FileMeta):
     def pdbg(self, indent):
         print indent, 'CharDev %d:%d %s' % (self.major, self.minor, self.dbg_meta())
     
+
+# Converts the directories below and including d to BTrees. 'commit' is
+# called after each conversion. Returns the number converted
+def convert_directories( d, commit ):
+    n = 0
+    if d.convert_content():
+        n += 1
+        commit()
+    for v in d.content.values():
+        if v.ftype == fs.DIRECTORY:
+            n += convert_directories( v, commit )
+    return n
+
+
+# Caches the fq_name of every entry below d and adds it to the path
+# index. 'commit' is called after each entry. Returns the number indexed
+def index_paths( d, paths, commit ):
+    n      = 0
+    prefix = d.get_fq_name() + '/'
+    for v in d.content.values():
+        v.fq_name = prefix + v.name
+        paths[ v.fq_name ] = v
+        n += 1
+        commit()
+        if v.ftype == fs.DIRECTORY:
+            n += index_paths( v, paths, commit )
+    return n
+
+    
 #----------------------------------------------------------------------------------
 # File System Database
 #----------------------------------------------------------------------------------
 
 class FileSystems (Persistent):
+
+    # Databases that predate the compact inode index hold a
+    # PersistentList of [file_id, path, path, ...] per inode in inode_map
+    # instead. See migrate_inode_map()
+    inode_map = None
+    inodes    = None
+    links     = None
+    
     def __init__(self):
         self.next_fs_id   = 1
         self.mounts       = PersistentMapping()
-        self.inode_map    = PersistentMapping()
+        self.inodes       = PersistentMapping() # fs_id => LOBTree of inode => (file_id, link count[, File])
+        self.links        = PersistentMapping() # fs_id => LOBTree of inode => PersistentList of paths
 
         
     def add_mount(self, mount_point):
@@ -156,88 +236,295 @@ class FileSystems (Persistent):
         self.next_fs_id += 1
 
         self.mounts[ mount_point ] = i
-        self.inode_map[ i ] = IOBTree() # maps Inode Number to list of paths
+        self.inodes[ i ] = LOBTree()
+        self.links[ i ]  = LOBTree()
 
         import transaction
         transaction.commit()
 
-        
-    def link_inode(self, fs_id, inode, file_id, path):
-        t = self.inode_map[ fs_id ]
-        if not inode in t:
-            t[ inode ] = PersistentList()
-            t[ inode ].append( file_id )
-        t[ inode ].append( path )
+
+    # Paths are only recorded for files with more than one link on the
+    # filesystem; the link count alone is enough for the rest. An inode
+    # with a single link keeps a reference to its File instead, so that
+    # the path can be recorded should a second link appear later
+    def link_inode(self, fs_id, inode, file_id, path, nlink = 1, db_file = None):
+        t = self.inodes[ fs_id ]
+        v = t.get( inode )
+
+        if v is not None:
+            t[ inode ] = (v[0], v[1] + 1)
+        elif nlink > 1 or db_file is None:
+            t[ inode ] = (file_id, 1)
+        else:
+            t[ inode ] = (file_id, 1, db_file)
+
+        if nlink > 1:
+            l = self.links[ fs_id ].get( inode )
+            if l is None:
+                l = self.links[ fs_id ][ inode ] = PersistentList()
+                if v is not None and len(v) > 2:
+                    l.append( v[2].get_fq_name() ) # Scanned while it had a single link
+            l.append( path )
 
 
     def unlink_inode(self, fs_id, inode, path):
-        l = self.inode_map[ fs_id ][ inode ]
-        l.remove( path )
+        t = self.inodes[ fs_id ]
+        v = t.get( inode )
 
-        # If only the file_id is left, remove it completely. The
-        # inode may be recycled by the file system
-        if len(l) == 1:
-            del self.inode_map[ fs_id ][ inode ]
+        if v is None:
+            return # Never linked, such as files stored inline
+        
+        # Once the last link is gone, remove it completely. The inode
+        # may be recycled by the file system
+        if v[1] <= 1:
+            del t[ inode ]
+            self.links[ fs_id ].pop( inode, None )
+            return
+
+        # The remaining links are all recorded
+        t[ inode ] = (v[0], v[1] - 1)
+
+        l = self.links[ fs_id ].get( inode )
+        if l is not None and path in l:
+            l.remove( path )
+            if not l:
+                del self.links[ fs_id ][ inode ]
         
 
 
     def get_inode_file_id(self, fs_id, inode):
-        try:
-            return self.inode_map[ fs_id ][ inode ][0]
-        except KeyError:
-            return None
+        v = self.inodes[ fs_id ].get( inode )
+        return None if v is None else v[0]
 
 
     def get_inode_paths(self, fs_id, inode):
-        try:
-            return self.inode_map[ fs_id ][ inode ][1:]
-        except KeyError:
-            return []
+        return list( self.links[ fs_id ].get( inode, () ) )
+
+
+    def inode_report(self):
+        ninodes = nlinked = npaths = 0
+        for fs_id, t in self.inodes.iteritems():
+            ninodes += len( t )
+            for l in self.links[ fs_id ].itervalues():
+                nlinked += 1
+                npaths  += len( l )
+        return '%d inodes, %d with multiple links holding %d paths' % (ninodes, nlinked, npaths)
+
+
+    # Converts inode_map. 'commit' is called after each inode. Rerun
+    # from scratch if interrupted
+    def migrate_inode_map(self, commit):
+        self.inodes = PersistentMapping()
+        self.links  = PersistentMapping()
         
-    
-    def check_filesystems(self):
-        mtbl = fs.get_mount_table()
+        for fs_id, old in self.inode_map.iteritems():
+            t = self.inodes[ fs_id ] = LOBTree()
+            p = self.links[ fs_id ]  = LOBTree()
+            
+            for inode, l in old.iteritems():
+                t[ inode ] = (l[0], len(l) - 1)
+                if len(l) > 2:
+                    p[ inode ] = PersistentList( l[1:] )
+                commit()
+
+        self.inode_map = None
+
+
+    # Adds the File reference to the entries of inodes with a single link
+    # that predate it. 'paths' is the path index. 'commit' is called after
+    # each inode
+    def reference_single_links(self, paths, commit):
+        for f in paths.itervalues():
+            if f.ftype != fs.REGULAR or f.file_id is None or not f.fs_id in self.inodes:
+                continue
+            t = self.inodes[ f.fs_id ]
+            v = t.get( f.inode )
+            if v is not None and len(v) == 2 and v[1] == 1 and not f.inode in self.links[ f.fs_id ]:
+                t[ f.inode ] = (v[0], 1, f)
+                commit()
 
-        for mount, is_local in mtbl.iteritems():
-            if is_local and not mount in self.mounts:
-                self.add_mount( mount )
+        
+    def check_filesystems(self):
+        for m in fs.mounts.get_mount_table():
+            if m.is_local and not m.mount_point in self.mounts:
+                self.add_mount( m.mount_point )
                 
 #----------------------------------------------------------------------------------
 # File Store Database
 #----------------------------------------------------------------------------------
 
+# Store data lives in a series of segment files. Segment 0 is the
+# original single store file, so DBFiles stored before segments existed
+# need no migration
+SEGMENT_SIZE = 1024 * 1024 * 1024
+
+
 class DBFile (Persistent):
-    def __init__(self, file_id, offset, length, zlength):
+
+    digest        = None # Files stored before content hashing have none
+    chunks        = None
+    chunk_offsets = None
+    codec         = 'zlib'
+    segment       = 0
+    
+    def __init__(self, file_id, offset, length, zlength, digest = None, chunks = None, codec = 'zlib',
+                 chunk_offsets = None, segment = 0):
         self.file_id = file_id
-        self.offset  = offset
+        self.segment = segment # None if no data is stored
+        self.offset  = offset  # Within the segment
         self.length  = length
         self.zlength = zlength # compressed length
+        self.digest  = digest  # sha256 of the uncompressed content
+        self.chunks  = chunks  # Tuple of chunk file_ids or None. Chunked files store no data themselves
+        self.codec   = codec   # See codecs.py
+
+        # Uncompressed offset of each chunk within the file
+        self.chunk_offsets = chunk_offsets
+
+
+
+class Segment (Persistent):
+    def __init__(self, number):
+        self.number = number
+        self.size   = 0 # Bytes allocated
+        self.live   = 0 # Bytes allocated to DBFiles that still exist
+
 
 
-        
 class FileDatabase (Persistent):
+
+    hashes          = None # Created on first use for databases that predate it
+    segments        = None # Likewise
+    current_segment = 0
+    retired         = None # Segment numbers whose files await deletion
+    segment_size    = SEGMENT_SIZE
+    
     def __init__(self):
         self.next_file_id       = 1
         self.files              = IOBTree()
+        self.hashes             = OOBTree() # content digest => file_id
+        self.segments           = IOBTree() # segment number => Segment
+        self.retired            = PersistentList()
+
+        self.segments[ 0 ]      = Segment( 0 )
+
+    # Returns the file_id of stored content with the given digest and
+    # length or None
+    def find_content(self, digest, length):
+        if self.hashes is None:
+            return None
+        
+        file_id = self.hashes.get( digest )
+        
+        if file_id is not None and self.files[ file_id ].length == length:
+            return file_id
+
+        return None
+
+    # Chunked files stored without a frame index have it rebuilt from the
+    # chunk lengths
+    def get_chunk_offsets(self, dbf):
+        if dbf.chunk_offsets is not None:
+            return dbf.chunk_offsets
+
+        starts = list()
+        pos    = 0
+        for chunk_id in dbf.chunks:
+            starts.append( pos )
+            pos += self.files[ chunk_id ].length
+        return starts
         
+    def index_content(self, file_id, digest):
+        if self.hashes is None:
+            self.hashes = OOBTree()
+        if not digest in self.hashes:
+            self.hashes[ digest ] = file_id
+
+    def unindex_content(self, file_id, digest):
+        if self.hashes is not None and self.hashes.get( digest ) == file_id:
+            del self.hashes[ digest ]
+
+    # End of the data in the original single store file
     def get_last_offset(self):
         if self.next_file_id == 1:
             return 0
         else:
             lf = self.files[ self.next_file_id - 1 ]
             return lf.offset + lf.zlength
-    
-    def add_file(self, file_length, file_zlength):
+
+    # Databases that predate segments hold everything in segment 0. Its
+    # live byte count is corrected by the next compaction
+    def _init_segments(self):
+        s      = Segment( 0 )
+        s.size = s.live = self.get_last_offset()
+        
+        self.segments        = IOBTree()
+        self.segments[ 0 ]   = s
+        self.current_segment = 0
+        if self.retired is None:
+            self.retired = PersistentList()
+
+    def get_segments(self):
+        if self.segments is None:
+            self._init_segments()
+        return self.segments
+
+    # Reserves zlength bytes at the end of the current segment, starting a
+    # new one if they do not fit. Returns (segment, offset). The space is
+    # released again if the transaction aborts
+    def allocate(self, zlength):
+        segs = self.get_segments()
+        s    = segs[ self.current_segment ]
+        
+        if s.size > 0 and s.size + zlength > self.segment_size:
+            s = Segment( segs.maxKey() + 1 )
+            segs[ s.number ]     = s
+            self.current_segment = s.number
+
+        offset  = s.size
+        s.size += zlength
+        s.live += zlength
+
+        return s.number, offset
+
+    def get_store_size(self):
+        return sum( s.size for s in self.get_segments().itervalues() )
+
+    # 'location' is the (segment, offset) returned by allocate() for the
+    # file's data. Files without data need none
+    def add_file(self, file_length, file_zlength, digest = None, chunks = None, codec = 'zlib',
+                 chunk_offsets = None, location = None):
         i = self.next_file_id
+
+        if location is None:
+            if file_zlength:
+                raise Exception('No store location given for %d bytes of data' % file_zlength)
+            location = (None, 0)
         
-        self.files[i] = DBFile( i, self.get_last_offset(), file_length, file_zlength )
+        self.files[i] = DBFile( i, location[1], file_length, file_zlength, digest, chunks, codec,
+                                chunk_offsets, location[0] )
+
+        if digest is not None:
+            self.index_content( i, digest )
 
         self.next_file_id += 1
         
         return i
 
-    
+    def remove_file(self, file_id):
+        dbf = self.files[ file_id ]
+        
+        if dbf.zlength:
+            s = self.get_segments().get( dbf.segment )
+            if s is not None:
+                s.live -= dbf.zlength
+
+        if dbf.digest is not None:
+            self.unindex_content( file_id, dbf.digest )
+            
+        del self.files[ file_id ]
 
+    
                 
 #----------------------------------------------------------------------------------
 # Patch Database
@@ -255,14 +542,24 @@ class PatchedDirectory (FileMeta):
     def __init__(self, name, parent, uid, gid, mode, mtime_ns):
         FileMeta.__init__(self, name, parent, uid, gid, mode, mtime_ns)
         
-        self.adds         = PersistentMapping()
-        self.removes      = PersistentMapping()
-        self.meta_changes = PersistentMapping() # name => ((to_uid, to_gid, to_mode), (from_uid, from_gid, from_mode))
+        self.adds         = OOBTree()
+        self.removes      = OOBTree()
+        self.meta_changes = OOBTree() # name => ((to_uid, to_gid, to_mode), (from_uid, from_gid, from_mode))
 
-        self.subdirs      = PersistentMapping()
+        self.subdirs      = OOBTree()
 
         self.state        = PatchedDirectory.EXISTING
 
+    # As Directory.convert_content()
+    def convert_maps(self):
+        converted = False
+        for attr in ('adds', 'removes', 'meta_changes', 'subdirs'):
+            m = getattr( self, attr )
+            if not isinstance( m, OOBTree ):
+                setattr( self, attr, OOBTree( dict( m ) ) )
+                converted = True
+        return converted
+
     def pdbg(self, indent = ''):
         s = { 0 : 'EXISTING', 1 : 'ADDED', 2 : 'REMOVED' }
         
@@ -284,6 +581,17 @@ class PatchedDirectory (FileMeta):
 
         for s in self.subdirs.itervalues():
             s.pdbg( indent + '   ' )
+
+
+# As convert_directories(), for the PatchedDirectories of a patch
+def convert_patch_directories( pd, commit ):
+    n = 0
+    if pd.convert_maps():
+        n += 1
+        commit()
+    for s in pd.subdirs.values():
+        n += convert_patch_directories( s, commit )
+    return n
                 
 
 
@@ -334,6 +642,17 @@ class PatchDatabase (Persistent):
         
         return p
 
+    # Discards complete patches numbered below first_kept. Their content
+    # remains in the store until the next compaction
+    def prune(self, first_kept):
+        if self.last_patch_id is None or first_kept > self.last_patch_id:
+            raise Exception('The most recent patch cannot be pruned')
+
+        for n in list( self.patches.keys( max = first_kept - 1 ) ):
+            if not self.patches[ n ].is_complete:
+                raise Exception('Patch %d is incomplete' % n)
+            del self.patches[ n ]
+
 
 
     
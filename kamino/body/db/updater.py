@@ -1,8 +1,6 @@
 import os
 import os.path
 
-import transaction
-
 from   kamino.body               import fs
 from   kamino.body.db            import types
 from   kamino.body.db.file_store import FileStore
@@ -26,6 +24,10 @@ class DBUpdater (object):
         self.file_store = body_db.file_store
         self.indent     = ''
 
+        # Cleared by wrapping Deltas, such as PatchCreator, that commit
+        # their own changes along with the updater's
+        self.auto_commit = True
+
         
     def push_dir(self, dir_name):
         self.indent += '   '
@@ -40,6 +42,9 @@ class DBUpdater (object):
         self.indent = self.indent[:-3]
         self.db_dir = self.db_dir.parent
 
+        if self.db_dir is None:
+            self._commit( True ) # End of the scan
+
 
     def content_added(self, fs_file, force_zero_length = False):
         db_file = _db_constructor[ fs_file.ftype ]( fs_file.name, self.db_dir, fs_file.uid, fs_file.gid, fs_file.mode, fs_file.mtime_ns )
@@ -53,18 +58,30 @@ class DBUpdater (object):
             db_file.fs_id    = fs_file.fs_id
 
             file_id = None
+            inline  = self.file_store.encode_inline( fs_file, force_zero_length )
+
+            if inline is not None:
+                db_file.inline = inline
             
-            if fs_file.nlink > 1:
+            elif fs_file.nlink > 1:
                 file_id = self.fs_db.get_inode_file_id( fs_file.fs_id, fs_file.inode )
+
+            hardlink = file_id is not None
                 
-            if file_id is None:
+            if file_id is None and inline is None:
                 file_id = self.file_store.add_file( fs_file, force_zero_length )
-            else:
-                print self.indent, '   HARDLINK to existing file: ', self.fs_db.get_inode_paths( fs_file.fs_id, fs_file.inode )
 
             db_file.file_id  = file_id
-        
-            self.fs_db.link_inode( db_file.fs_id, fs_file.inode, db_file.file_id, db_file.get_fq_name() )
+
+            if file_id is not None:
+                self.fs_db.link_inode( db_file.fs_id, fs_file.inode, file_id, db_file.get_fq_name(),
+                                       fs_file.nlink, db_file )
+
+            # Reported once linked, as the first link's path may only just
+            # have been recorded
+            if hardlink:
+                paths = self.fs_db.get_inode_paths( fs_file.fs_id, fs_file.inode )
+                print self.indent, '   HARDLINK to existing file: ', [ p for p in paths if p != db_file.get_fq_name() ]
                 
         
         elif db_file.ftype == fs.SYMLINK:
@@ -75,8 +92,9 @@ class DBUpdater (object):
             db_file.dev_minor = fs_file.dev_minor
 
         self.db_dir.content[ db_file.name ] = db_file
+        self._index( db_file )
 
-        transaction.commit()
+        self._commit()
 
         return db_file
 
@@ -93,14 +111,15 @@ class DBUpdater (object):
             self.fs_db.unlink_inode( db_file.fs_id, db_file.inode, db_file.get_fq_name() )
         
         del self.db_dir.content[ db_file.name ]
+        self._unindex( db_file )
 
-        transaction.commit()
+        self._commit()
         
 
     def metadata_changed(self, db_file, fs_file):
         print self.indent, 'MetaChange: ', fs_file.name, (db_file.uid, db_file.gid, db_file.mode), ' ==> ', (fs_file.uid, fs_file.gid, fs_file.mode)
         db_file.uid, db_file.gid, db_file.mode = fs_file.uid, fs_file.gid, fs_file.mode
-        transaction.commit()
+        self._commit()
 
         
     # Called in a bottom-up manner
@@ -108,8 +127,9 @@ class DBUpdater (object):
         print self.indent, 'Removing Dir: ', db_dir.name
         
         del self.db_dir.content[ db_dir.name ]
+        self._unindex( db_dir )
             
-        transaction.commit()
+        self._commit()
 
         
     # Called in a top-down manner
@@ -118,5 +138,26 @@ class DBUpdater (object):
         
         db_dir = types.Directory( fs_dir.name, self.db_dir, fs_dir.uid, fs_dir.gid, fs_dir.mode, fs_dir.mtime_ns )
         self.db_dir.content[ db_dir.name ] = db_dir
+        self._index( db_dir )
+
+        self._commit()
+
+
+    def directory_scanned(self, fs_dir):
+        self.db_dir.record_stat( fs_dir )
+
+        self._commit( self.body_db.commit_at_dirs )
+
+
+    def _index(self, db_f):
+        if self.body_db.path_index is not None:
+            self.body_db.path_index[ db_f.get_fq_name() ] = db_f
+
+    def _unindex(self, db_f):
+        if self.body_db.path_index is not None:
+            self.body_db.path_index.pop( db_f.get_fq_name(), None )
+
 
-        transaction.commit()
+    def _commit(self, force = False):
+        if self.auto_commit:
+            self.body_db.commit( force )
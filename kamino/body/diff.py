@@ -0,0 +1,152 @@
+# Read-only "what changed" report
+#
+# DiffDelta receives the Scanner callbacks and writes one JSON record per
+# change instead of updating the database:
+#
+#   {"path": "/etc/passwd", "kind": "modified", "type": "File",
+#    "old_size": 1520, "new_size": 1561}
+#
+# kind is one of added, removed, modified or metadata. Sizes are only
+# present for regular files; metadata records carry "old" and "new"
+# [uid, gid, mode] lists instead. Paths are relative to the scan root.
+# Paths that are not valid UTF-8 are written with Python string escapes.
+#
+# Nothing is written to the file store and no transaction is committed,
+# so this can run against a BodyDB opened read_only, alongside a writer.
+#
+import sys
+import time
+import json
+import optparse
+
+from kamino.body    import fs
+from kamino.body    import scanner
+from kamino.body.db import BodyDB
+
+
+def _text( path ):
+    try:
+        return path.decode('utf-8')
+    except UnicodeDecodeError:
+        return path.encode('string_escape')
+
+
+
+class DiffDelta (scanner.Delta):
+
+    def __init__(self, out):
+        self.out     = out
+        self.paths   = list()
+        self.removed = dict() # name => db_file. Pending removals in this directory
+        self.counts  = dict( added = 0, removed = 0, modified = 0, metadata = 0 )
+
+
+    def _path(self, name):
+        return self.paths[-1] + '/' + name
+
+
+    def _emit(self, path, kind, ftype, **kw):
+        self.counts[ kind ] += 1
+        kw['path'] = _text( path )
+        kw['kind'] = kind
+        kw['type'] = fs.tmap[ ftype ]
+        self.out.write( json.dumps( kw, sort_keys = True ) + '\n' )
+
+
+    # A modified file is reported by the Scanner as a removal followed by
+    # an addition in the same directory. Removals are held back until it
+    # is known whether an addition pairs with them
+    def _flush(self):
+        for name, db_f in self.removed.iteritems():
+            if db_f.ftype == fs.REGULAR:
+                self._emit( self._path(name), 'removed', db_f.ftype, old_size = db_f.size )
+            else:
+                self._emit( self._path(name), 'removed', db_f.ftype )
+        self.removed.clear()
+
+
+    def push_dir(self, dir_name):
+        self._flush()
+        self.paths.append( self._path(dir_name) if self.paths else '' )
+
+    def pop_dir(self):
+        self._flush()
+        self.paths.pop()
+
+    def content_added(self, fs_file, force_zero_length=False):
+        db_f = self.removed.pop( fs_file.name, None )
+
+        kw = dict()
+        if fs_file.ftype == fs.REGULAR:
+            kw['new_size'] = fs_file.size
+        if db_f is not None and db_f.ftype == fs.REGULAR:
+            kw['old_size'] = db_f.size
+
+        self._emit( self._path(fs_file.name), 'added' if db_f is None else 'modified', fs_file.ftype, **kw )
+
+    def content_removed(self, db_file):
+        self.removed[ db_file.name ] = db_file
+
+    def metadata_changed(self, db_file, fs_file):
+        self._flush()
+        self._emit( self._path(db_file.name), 'metadata', db_file.ftype,
+                    old = [db_file.uid, db_file.gid, db_file.mode],
+                    new = [fs_file.uid, fs_file.gid, fs_file.mode] )
+
+    def directory_removed(self, db_dir):
+        self._flush()
+        self._emit( self._path(db_dir.name), 'removed', fs.DIRECTORY )
+
+    def directory_added(self, fs_dir):
+        self._flush()
+        self._emit( self._path(fs_dir.name), 'added', fs.DIRECTORY )
+
+
+
+def diff( body_db, root_fs_dir, out, filter_obj = None, num_workers = 1, incremental = False ):
+    d = DiffDelta( out )
+    s = scanner.Scanner( root_fs_dir, body_db, d, filter_obj or scanner.Filter(),
+                         num_workers = num_workers, incremental = incremental )
+    s.scan()
+    out.flush()
+    return d, s
+
+
+
+def main():
+    parser = optparse.OptionParser( usage = '%prog [options] DB_DIR ROOT' )
+    parser.add_option( '-f', '--filter', help = 'Scan filter rules file' )
+    parser.add_option( '-j', '--workers', type = 'int', default = 1,
+                       help = 'Number of directory reading threads' )
+    parser.add_option( '-i', '--incremental', action = 'store_true', default = False,
+                       help = 'Skip directories whose mtime has not changed' )
+
+    opts, args = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error( 'A database directory and a root directory are required' )
+
+    filt = scanner.Filter()
+    if opts.filter:
+        filt.load_rules( opts.filter )
+
+    # Keep stdout for the records alone
+    out        = sys.stdout
+    sys.stdout = sys.stderr
+
+    t = time.time()
+
+    body_db = BodyDB( args[0], read_only = True )
+
+    d, s = diff( body_db, args[1], out, filt, opts.workers, opts.incremental )
+
+    t = time.time() - t
+
+    sys.stderr.write( 'DIFF: %d added, %d removed, %d modified, %d metadata. '
+                      'Listed %d directories in %.3f s\n' % (
+                          d.counts['added'], d.counts['removed'], d.counts['modified'],
+                          d.counts['metadata'], s.listed_dirs, t) )
+
+
+if __name__ == '__main__':
+    main()
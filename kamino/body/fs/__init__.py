@@ -1,6 +1,5 @@
 import os
 import os.path
-import subprocess
 
 DIRECTORY = 1
 REGULAR   = 2
@@ -19,6 +18,7 @@ tmap = { DIRECTORY : 'Directory',
          CHARDEV   : 'CharDev' }
 
 from kamino.body.fs import cwrap
+from kamino.body.fs import mounts
 
 ftype_map = { cwrap.S_IFDIR  : DIRECTORY,
               cwrap.S_IFREG  : REGULAR,
@@ -29,73 +29,80 @@ ftype_map = { cwrap.S_IFDIR  : DIRECTORY,
               cwrap.S_IFCHR  : CHARDEV }
 
 
-local_filesystems = set( ['ext2', 'ext3', 'ext4', 'btrfs'] )
+local_filesystems = mounts.local_filesystems
 
 
+# Returns a dict of mount point => is_local. Use mounts.get_mount_table()
+# for lookups by st_dev
 def get_mount_table():
-    mtbl = dict()
-    
-    # Ignore all non-local file systems
-    mounts = subprocess.Popen(['mount',], stdout=subprocess.PIPE).communicate()[0]
-        
-    for line in mounts.split('\n'):
-        p = line.split()
-        if p:
-            mtbl[ p[2] ] = p[4] in local_filesystems
-
-    return mtbl
+    return dict( (m.mount_point, m.is_local) for m in mounts.get_mount_table() )
 
 
 
 class File (object):
 
-    def __init__(self, name, fq_name, s):
-        self.ftype    = ftype_map[ s.st_mode & cwrap.S_IFMT ]
+    # Scans can hold hundreds of thousands of these at once, so there is
+    # no per-instance __dict__ and the full path is not stored; the
+    # directory path string is shared by every entry of a directory.
+    # Type-specific attributes are only set for the matching ftype.
+    __slots__ = ('ftype', 'name', 'dir_path', 'uid', 'gid', 'mode', 'mtime_ns',
+                 'inode', 'nlink', 'size', 'dev', 'fs_id', 'compressed', 'ctime_ns',
+                 'target', 'dev_major', 'dev_minor')
+
+    # 'st' is a flat list of cwrap.read_dir_stats fields and 'i' is the
+    # index of this entry's first field
+    def __init__(self, name, dir_path, st, i = 0):
+        mode, uid, gid, inode, nlink, size, mtime_ns, ctime_ns, dev = st[ i : i + cwrap.DS_DEV + 1 ]
+        
+        self.ftype    = ftype_map[ mode & cwrap.S_IFMT ]
         self.name     = name
-        self.fq_name  = fq_name
-        self.uid      = int(s.st_uid)
-        self.gid      = int(s.st_gid)
-        self.mode     = int(s.st_mode & ~cwrap.S_IFMT)
-        self.mtime_ns = long(s.st_mtime.tv_sec * 1000000000 + s.st_mtime.tv_nsec)
+        self.dir_path = dir_path
+        self.uid      = uid
+        self.gid      = gid
+        self.mode     = mode & ~cwrap.S_IFMT
+        self.mtime_ns = mtime_ns
         
         if self.ftype == REGULAR:
-            self.inode    = int(s.st_ino)
-            self.nlink    = int(s.st_nlink)
-            self.size     = long(s.st_size)
-            self.fs_id    = None # Optional value that may be added by Scanner module
+            self.inode      = inode
+            self.nlink      = nlink
+            self.size       = size
+            self.dev        = dev
+            self.fs_id      = None # Optional value that may be added by Scanner module
+            self.compressed = None # Optional value that may be added by db.pipeline
+
+        elif self.ftype == DIRECTORY:
+            self.inode    = inode
+            self.ctime_ns = ctime_ns
+            self.dev      = dev
 
         elif self.ftype == SYMLINK:
             self.target = os.readlink( self.fq_name )
 
         elif self.ftype in (BLOCKDEV, CHARDEV):
-            self.dev_major = int(s.st_rdev.major)
-            self.dev_minor = int(s.st_rdev.minor)
-        
+            self.dev_major = st[ i + cwrap.DS_RDEV_MAJOR ]
+            self.dev_minor = st[ i + cwrap.DS_RDEV_MINOR ]
 
 
-def read_dir( path ):
-
-    if not os.path.isdir(path):
-        print '#### BAD PATH: ', path
-    assert os.path.isdir(path)
-
-    content = dict()
-    
-    for fn in os.listdir( path ):
-
-        fqfn = os.path.join(path, fn)
+    @property
+    def fq_name(self):
+        return os.path.join( self.dir_path, self.name )
         
-        s = cwrap.lstat( fqfn )
 
-        if s is None:
-            raise Exception("Failed to lstat " + fqfn)
 
-        content[ fn ] = File( fn, fqfn, s )
+def stat_file( path ):
+    return File( os.path.basename(path), os.path.dirname(path), cwrap.lstat_fields( path ) )
 
-    return content
 
-        
 
+def read_dir( path ):
 
+    names, st = cwrap.read_dir_stats( path )
 
+    content = dict()
+    i       = 0
+    
+    for fn in names:
+        content[ fn ] = File( fn, path, st, i )
+        i += cwrap.DS_NFIELDS
 
+    return content
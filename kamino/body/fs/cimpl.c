@@ -3,12 +3,17 @@
 //
 // gcc -shared -Wl,-soname,libstatwrap.so.1 -o libstatwrap.so.1.0 -fPIC t2.c
 
+#define _GNU_SOURCE
+
 #include <sys/types.h>
 #include <sys/stat.h>
 #include <sys/vfs.h>
+#include <sys/sysmacros.h>
+#include <sys/syscall.h>
 #include <unistd.h>
 #include <stdlib.h>
 #include <stdio.h>
+#include <string.h>
 #include <errno.h>
 #include <fcntl.h>
 
@@ -82,3 +87,229 @@ int set_mtime_ns( const char * abs_filename, long sec, long nsec )
 }
 
 
+
+//----------------------------------------------------------------------------------
+// Batched directory reading
+//
+// read_dir_stats() lists a directory with getdents64 and lstats every
+// entry with fstatat relative to the directory fd. The result is
+// returned as one flat array of DSTAT_NFIELDS long longs per entry plus
+// a single buffer of NUL-terminated names, so the caller can consume a
+// whole directory with two copies. Entries that vanish between listing
+// and stat are skipped. Release the result with free_dir_stats().
+//----------------------------------------------------------------------------------
+
+enum {
+   DSTAT_MODE,
+   DSTAT_UID,
+   DSTAT_GID,
+   DSTAT_INO,
+   DSTAT_NLINK,
+   DSTAT_SIZE,
+   DSTAT_MTIME_NS,
+   DSTAT_CTIME_NS,
+   DSTAT_DEV,
+   DSTAT_RDEV_MAJOR,
+   DSTAT_RDEV_MINOR,
+   DSTAT_NFIELDS
+};
+
+struct dir_stats {
+   long        count;
+   long long * fields;
+   char *      names;
+   long        names_len;
+};
+
+struct linux_dirent64 {
+   unsigned long long d_ino;
+   long long          d_off;
+   unsigned short     d_reclen;
+   unsigned char      d_type;
+   char               d_name[];
+};
+
+#define DENTS_BUF_SIZE (64 * 1024)
+
+
+void free_dir_stats( struct dir_stats * ds )
+{
+   if ( ds ) {
+      free( ds->fields );
+      free( ds->names );
+      free( ds );
+   }
+}
+
+
+static int grow( void ** p, long * capacity, long needed, long elem_size )
+{
+   long   ncap = *capacity ? *capacity : 256;
+   void * np;
+   
+   if ( needed <= *capacity )
+      return 0;
+
+   while ( ncap < needed )
+      ncap *= 2;
+
+   np = realloc( *p, ncap * elem_size );
+
+   if ( !np )
+      return -1;
+
+   *p        = np;
+   *capacity = ncap;
+
+   return 0;
+}
+
+
+struct dir_stats * read_dir_stats( const char * path )
+{
+   struct dir_stats * ds       = calloc( 1, sizeof(struct dir_stats) );
+   long               fcap     = 0;
+   long               ncap     = 0;
+   char *             buf      = malloc( DENTS_BUF_SIZE );
+   int                fd       = -1;
+   int                err      = 0;
+   long               nread, off;
+   
+   if ( !ds || !buf ) {
+      err = ENOMEM;
+      goto fail;
+   }
+   
+   fd = open( path, O_RDONLY | O_DIRECTORY | O_CLOEXEC );
+
+   if ( fd < 0 ) {
+      err = errno;
+      goto fail;
+   }
+
+   while ( (nread = syscall( SYS_getdents64, fd, buf, DENTS_BUF_SIZE )) > 0 ) {
+      
+      for ( off = 0; off < nread; ) {
+         struct linux_dirent64 * d = (struct linux_dirent64 *) (buf + off);
+         struct stat             s;
+         long long *             f;
+         long                    nlen;
+
+         off += d->d_reclen;
+
+         if ( d->d_name[0] == '.' && (d->d_name[1] == '\0' ||
+                                      (d->d_name[1] == '.' && d->d_name[2] == '\0')) )
+            continue;
+
+         if ( fstatat( fd, d->d_name, &s, AT_SYMLINK_NOFOLLOW ) < 0 ) {
+            if ( errno == ENOENT )
+               continue;
+            err = errno;
+            goto fail;
+         }
+
+         nlen = strlen( d->d_name ) + 1;
+
+         if ( grow( (void **) &ds->fields, &fcap, (ds->count + 1) * DSTAT_NFIELDS, sizeof(long long) ) ||
+              grow( (void **) &ds->names, &ncap, ds->names_len + nlen, 1 ) ) {
+            err = ENOMEM;
+            goto fail;
+         }
+
+         memcpy( ds->names + ds->names_len, d->d_name, nlen );
+         ds->names_len += nlen;
+         
+         f = ds->fields + ds->count * DSTAT_NFIELDS;
+
+         f[DSTAT_MODE]       = s.st_mode;
+         f[DSTAT_UID]        = s.st_uid;
+         f[DSTAT_GID]        = s.st_gid;
+         f[DSTAT_INO]        = s.st_ino;
+         f[DSTAT_NLINK]      = s.st_nlink;
+         f[DSTAT_SIZE]       = s.st_size;
+         f[DSTAT_MTIME_NS]   = s.st_mtim.tv_sec * 1000000000LL + s.st_mtim.tv_nsec;
+         f[DSTAT_CTIME_NS]   = s.st_ctim.tv_sec * 1000000000LL + s.st_ctim.tv_nsec;
+         f[DSTAT_DEV]        = s.st_dev;
+         f[DSTAT_RDEV_MAJOR] = major(s.st_rdev);
+         f[DSTAT_RDEV_MINOR] = minor(s.st_rdev);
+
+         ds->count++;
+      }
+   }
+
+   if ( nread < 0 ) {
+      err = errno;
+      goto fail;
+   }
+
+   close( fd );
+   free( buf );
+   
+   return ds;
+
+ fail:
+   if ( fd >= 0 )
+      close( fd );
+   free( buf );
+   free_dir_stats( ds );
+   errno = err;
+   return NULL;
+}
+
+
+
+//----------------------------------------------------------------------------------
+// Content defined chunking
+//----------------------------------------------------------------------------------
+
+// Gear hash table. Generated with splitmix64 from a fixed seed so that
+// chunk boundaries are identical on every host
+static unsigned long long gear[256];
+static int                gear_ready = 0;
+
+static void init_gear( void )
+{
+   unsigned long long x = 0x6b616d696e6f4344ULL;
+   int i;
+
+   for ( i = 0; i < 256; i++ ) {
+      unsigned long long z = ( x += 0x9e3779b97f4a7c15ULL );
+      z = ( z ^ (z >> 30) ) * 0xbf58476d1ce4e5b9ULL;
+      z = ( z ^ (z >> 27) ) * 0x94d049bb133111ebULL;
+      gear[i] = z ^ (z >> 31);
+   }
+
+   gear_ready = 1;
+}
+
+
+// Returns the length of the chunk starting at buf + offset. 'len' is the
+// number of bytes available from there. A cut is made after the first
+// byte, at least min_size bytes in, that leaves the hash with all of the
+// bits in 'mask' clear. Chunks never exceed max_size. If no cut is found
+// within 'len' bytes, 'len' is returned
+long cdc_cut( const unsigned char * buf, long offset, long len, long min_size, long max_size,
+              unsigned long long mask )
+{
+   unsigned long long h = 0;
+   long               i;
+
+   if ( !gear_ready )
+      init_gear();
+
+   if ( len <= min_size )
+      return len;
+
+   if ( len > max_size )
+      len = max_size;
+
+   buf += offset;
+
+   for ( i = min_size; i < len; i++ ) {
+      h = ( h << 1 ) + gear[ buf[i] ];
+      if ( !(h & mask) )
+         return i + 1;
+   }
+
+   return len;
+}
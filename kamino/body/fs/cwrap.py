@@ -1,6 +1,8 @@
 import os
 import os.path
 import ctypes
+import struct
+import errno
 
 
 this_dir = os.path.abspath(os.path.dirname(__file__))
@@ -21,8 +23,8 @@ if not os.path.exists(cimplso):
     raise Exception('Wrapper library not built.')
 
 
-libc = ctypes.CDLL("libc.so.6")
-libcimpl = ctypes.CDLL(cimplso)
+libc = ctypes.CDLL("libc.so.6", use_errno=True)
+libcimpl = ctypes.CDLL(cimplso, use_errno=True)
 
 
 S_IFMT     = 0170000   #bit mask for the file type bit fields
@@ -76,12 +78,43 @@ class sstat (ctypes.Structure):
                  ] 
 
 
+
+# Field indices of the per-entry records returned by read_dir_stats.
+# Must match the DSTAT_* enum in cimpl.c
+DS_MODE       = 0
+DS_UID        = 1
+DS_GID        = 2
+DS_INO        = 3
+DS_NLINK      = 4
+DS_SIZE       = 5
+DS_MTIME_NS   = 6
+DS_CTIME_NS   = 7
+DS_DEV        = 8
+DS_RDEV_MAJOR = 9
+DS_RDEV_MINOR = 10
+DS_NFIELDS    = 11
+
+class dir_stats (ctypes.Structure):
+    _fields_ = [ ("count", ctypes.c_long),
+                 ("fields", ctypes.POINTER(ctypes.c_longlong)),
+                 ("names", ctypes.c_void_p),
+                 ("names_len", ctypes.c_long) ]
+
     
 TimespecArray = timespec * 2
 
 libc.futimens.argtypes               = [ctypes.c_int, TimespecArray]
+libc.inotify_init1.argtypes          = [ctypes.c_int]
+libc.inotify_add_watch.argtypes      = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
 libcimpl.statwrap.argtypes           = [ctypes.c_char_p, ctypes.POINTER(sstat)]
 libcimpl.set_mtime_ns.argtypes       = [ctypes.c_char_p, ctypes.c_long, ctypes.c_long]
+libcimpl.read_dir_stats.argtypes     = [ctypes.c_char_p]
+libcimpl.read_dir_stats.restype      = ctypes.POINTER(dir_stats)
+libcimpl.free_dir_stats.argtypes     = [ctypes.POINTER(dir_stats)]
+libcimpl.free_dir_stats.restype      = None
+libcimpl.cdc_cut.argtypes            = [ctypes.c_char_p, ctypes.c_long, ctypes.c_long, ctypes.c_long,
+                                        ctypes.c_long, ctypes.c_ulonglong]
+libcimpl.cdc_cut.restype             = ctypes.c_long
 
 def old_set_nsec_mtime( filename, mtime_in_nsec ):
     sec  = mtime_in_nsec / 1000000000
@@ -124,6 +157,59 @@ def lstat( fn ):
 
 
 
+# Returns the lstat of fn as a list of DS_NFIELDS values, laid out like
+# one entry of read_dir_stats
+def lstat_fields( fn ):
+    s = lstat( fn )
+
+    if s is None:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), fn)
+
+    return [ s.st_mode,
+             s.st_uid,
+             s.st_gid,
+             s.st_ino,
+             s.st_nlink,
+             s.st_size,
+             s.st_mtime.tv_sec * 1000000000 + s.st_mtime.tv_nsec,
+             s.st_ctime.tv_sec * 1000000000 + s.st_ctime.tv_nsec,
+             s.st_dev,
+             s.st_rdev.major,
+             s.st_rdev.minor ]
+
+
+
+# Returns (names, fields) for every entry in the directory. 'fields' is a
+# flat list holding DS_NFIELDS values per entry, in the same order as
+# 'names'.
+def read_dir_stats( path ):
+    p = libcimpl.read_dir_stats( path )
+
+    if not p:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), path)
+
+    try:
+        ds = p.contents
+        if ds.count == 0:
+            return [], []
+        names  = ctypes.string_at( ds.names, ds.names_len - 1 ).split('\0')
+        fields = ds.fields[ : ds.count * DS_NFIELDS ]
+    finally:
+        libcimpl.free_dir_stats( p )
+
+    return names, fields
+
+
+
+# Returns the length of the content defined chunk starting at 'offset'
+# within the string 'buf'. See cdc_cut in cimpl.c
+def cdc_cut( buf, offset, min_size, max_size, mask ):
+    return libcimpl.cdc_cut( buf, offset, len(buf) - offset, min_size, max_size, mask )
+
+
+
 def print_stat( s ):
     print 'dev', s.st_dev
     print 'ino', s.st_ino
@@ -143,3 +229,119 @@ def print_stat( s ):
     print 'ctime.sec', s.st_ctime.tv_sec
     print 'ctime.nsec', s.st_ctime.tv_nsec
     
+
+
+
+#----------------------------------------------------------------------------------
+# inotify
+#----------------------------------------------------------------------------------
+
+IN_ACCESS        = 0x00000001
+IN_MODIFY        = 0x00000002
+IN_ATTRIB        = 0x00000004
+IN_CLOSE_WRITE   = 0x00000008
+IN_MOVED_FROM    = 0x00000040
+IN_MOVED_TO      = 0x00000080
+IN_CREATE        = 0x00000100
+IN_DELETE        = 0x00000200
+IN_DELETE_SELF   = 0x00000400
+IN_MOVE_SELF     = 0x00000800
+IN_Q_OVERFLOW    = 0x00004000
+IN_IGNORED       = 0x00008000
+IN_ONLYDIR       = 0x01000000
+IN_DONT_FOLLOW   = 0x02000000
+IN_ISDIR         = 0x40000000
+IN_CLOEXEC       = 02000000
+
+_inotify_event = struct.Struct('iIII')
+
+def inotify_init():
+    fd = libc.inotify_init1( IN_CLOEXEC )
+    if fd < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return fd
+
+
+def inotify_add_watch( fd, path, mask ):
+    wd = libc.inotify_add_watch( fd, path, mask )
+    if wd < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), path)
+    return wd
+
+
+# Returns a list of (wd, mask, cookie, name) tuples
+def inotify_read( fd, bufsize = 64 * 1024 ):
+    buf    = os.read( fd, bufsize )
+    events = list()
+    off    = 0
+    
+    while off < len(buf):
+        wd, mask, cookie, nlen = _inotify_event.unpack_from( buf, off )
+        off += _inotify_event.size
+        name = buf[ off : off + nlen ].rstrip('\0')
+        off += nlen
+        events.append( (wd, mask, cookie, name) )
+
+    return events
+
+
+
+#----------------------------------------------------------------------------------
+# Kernel-side copies
+#----------------------------------------------------------------------------------
+
+_loff_p = ctypes.POINTER(ctypes.c_longlong)
+
+try:
+    libc.copy_file_range.argtypes = [ctypes.c_int, _loff_p, ctypes.c_int, _loff_p, ctypes.c_size_t, ctypes.c_uint]
+    libc.copy_file_range.restype  = ctypes.c_ssize_t
+    have_copy_file_range          = True
+except AttributeError:
+    have_copy_file_range          = False # glibc < 2.27
+
+libc.sendfile.argtypes = [ctypes.c_int, ctypes.c_int, _loff_p, ctypes.c_size_t]
+libc.sendfile.restype  = ctypes.c_ssize_t
+
+# Errors that mean the kernel cannot copy between these two files
+_unsupported = set( [errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF] )
+
+_MAX_COPY = 1024 * 1024 * 1024
+
+
+# Copies up to nbytes from in_fd at in_offset to out_fd at out_offset
+# without passing the data through user space. Tries copy_file_range,
+# then sendfile. The file offset of in_fd is not used or changed; out_fd
+# is left positioned after the copied data. Returns the number of bytes
+# copied, which is short if the input ended or if neither call supports
+# these files, in which case the caller must copy the rest itself
+def copy_range( in_fd, in_offset, out_fd, out_offset, nbytes ):
+    copied = 0
+
+    os.lseek( out_fd, out_offset, os.SEEK_SET )
+
+    for use_cfr in ([True, False] if have_copy_file_range else [False]):
+        while copied < nbytes:
+            off = ctypes.c_longlong( in_offset + copied )
+            n   = min( nbytes - copied, _MAX_COPY )
+
+            if use_cfr:
+                r = libc.copy_file_range( in_fd, ctypes.byref(off), out_fd, None, n, 0 )
+            else:
+                r = libc.sendfile( out_fd, in_fd, ctypes.byref(off), n )
+
+            if r < 0:
+                e = ctypes.get_errno()
+                if e == errno.EINTR:
+                    continue
+                if e in _unsupported:
+                    break
+                raise OSError(e, os.strerror(e))
+
+            if r == 0:
+                return copied # End of input
+
+            copied += r
+
+    return copied
@@ -0,0 +1,141 @@
+# Mount table parsed from /proc/self/mountinfo
+#
+# The table is cached and only re-read when the kernel flags the
+# mountinfo file as changed (POLLPRI/POLLERR on an fd that has already
+# been read), so repeated lookups cost no syscalls beyond a zero-timeout
+# poll. The kernel reports each change to only one poll() call, so the
+# result is latched until the table is re-read.
+#
+import os
+import re
+import select
+
+
+MOUNTINFO = '/proc/self/mountinfo'
+
+local_filesystems = set( ['ext2', 'ext3', 'ext4', 'btrfs'] )
+
+_octal_escape = re.compile(r'\\([0-7]{3})')
+
+def _unescape( s ):
+    return _octal_escape.sub( lambda m: chr(int(m.group(1), 8)), s )
+
+
+
+class Mount (object):
+
+    def __init__(self, mount_id, dev, root, mount_point, fstype, source):
+        self.mount_id    = mount_id
+        self.dev         = dev          # st_dev of files on this mount
+        self.root        = root         # Root of the mount within its filesystem
+        self.mount_point = mount_point
+        self.fstype      = fstype
+        self.source      = source
+        self.is_local    = fstype in local_filesystems
+
+
+
+def parse_mountinfo( text ):
+    mounts = list()
+
+    for line in text.split('\n'):
+        p = line.split(' ')
+
+        if len(p) < 10:
+            continue
+
+        # Optional fields end at the '-' separator
+        sep = p.index('-', 6)
+
+        major, minor = p[2].split(':')
+
+        mounts.append( Mount( int(p[0]),
+                              os.makedev( int(major), int(minor) ),
+                              _unescape( p[3] ),
+                              _unescape( p[4] ),
+                              p[ sep + 1 ],
+                              _unescape( p[ sep + 2 ] ) ) )
+
+    return mounts
+
+
+
+class MountTable (object):
+
+    def __init__(self, mountinfo_fn = MOUNTINFO):
+        self.mountinfo_fn = mountinfo_fn
+        self.fd           = None
+        self.poller       = None
+        self.stale        = True
+        self.by_path      = dict() # mount point => Mount
+        self.by_dev       = dict() # st_dev      => Mount
+
+
+    def __iter__(self):
+        return self.by_path.itervalues()
+
+
+    def is_stale(self):
+        if not self.stale and self.poller.poll(0):
+            self.stale = True
+        return self.stale
+
+
+    def refresh(self):
+        if not self.is_stale():
+            return
+
+        if self.fd is None:
+            self.fd     = os.open( self.mountinfo_fn, os.O_RDONLY )
+            self.poller = select.poll()
+            self.poller.register( self.fd, select.POLLPRI | select.POLLERR )
+
+        # Reading the file through the polled fd re-arms the notification
+        os.lseek( self.fd, 0, os.SEEK_SET )
+        chunks = list()
+        while True:
+            c = os.read( self.fd, 64 * 1024 )
+            if not c:
+                break
+            chunks.append( c )
+
+        self.stale = False
+
+        by_path = dict()
+        by_dev  = dict()
+
+        # Later entries are mounted on top of earlier ones
+        for m in parse_mountinfo( ''.join(chunks) ):
+            by_path[ m.mount_point ] = m
+
+        for m in by_path.itervalues():
+            # Prefer the mount showing the whole filesystem over bind
+            # mounts of one of its subdirectories
+            if not m.dev in by_dev or (m.root == '/' and by_dev[ m.dev ].root != '/'):
+                by_dev[ m.dev ] = m
+
+        self.by_path = by_path
+        self.by_dev  = by_dev
+
+
+    def close(self):
+        if self.fd is not None:
+            os.close( self.fd )
+            self.fd     = None
+            self.poller = None
+            self.stale  = True
+
+
+
+_table = None
+
+# Returns the shared, up to date MountTable
+def get_mount_table():
+    global _table
+
+    if _table is None:
+        _table = MountTable()
+
+    _table.refresh()
+
+    return _table
@@ -5,6 +5,7 @@ import socket
 
 from kamino.body    import fs
 from kamino.body.fs import cwrap
+from kamino.body.db import codecs
 
 #
 #
@@ -95,8 +96,12 @@ class Patcher (object):
         fn = os.path.join(fs_dir, f.name)
 
         if f.ftype == fs.REGULAR:
-            dbf = self.body_db.file_db.files[ f.file_id ]
-            self.body_db.file_store.extract_file( fn, dbf.offset, dbf.zlength )
+            if f.inline is not None:
+                with open( fn, 'w' ) as out:
+                    out.write( codecs.decompress( *f.inline ) )
+            else:
+                dbf = self.body_db.file_db.files[ f.file_id ]
+                self.body_db.file_store.extract( fn, dbf )
             
         elif f.ftype == fs.SYMLINK:
             os.symlink(f.target, fn)
@@ -8,7 +8,7 @@
 #
 # 2 File-Store Index Pickle (List of StoredFile instances)
 #
-# 3 File-Store Data (series of compressed files)
+# 3 File-Store Data (series of compressed files, in file_id order)
 #
 # 4 Series of DirDescrip pickles
 #     4-byte pickle length
@@ -19,8 +19,6 @@ import os.path
 import struct
 import cPickle as pickle
 
-import transaction
-
 from   kamino.body    import fs
 from   kamino.body.db import types
 
@@ -33,14 +31,28 @@ _db_constructor = { fs.REGULAR   : types.File,
 
 
 class StoredFile (object):
-    def __init__(self, file_id, offset, length, zlength):
+
+    digest        = None # Absent from patches exported before content hashing
+    chunks        = None
+    chunk_offsets = None
+    codec         = 'zlib'
+    
+    def __init__(self, file_id, offset, length, zlength, digest, chunks, codec, chunk_offsets):
         self.file_id = file_id
         self.offset  = offset
         self.length  = length
         self.zlength = zlength # compressed length
+        self.digest  = digest
+        self.chunks  = chunks  # Chunk file_ids. These may belong to earlier patches
+        self.codec   = codec
+
+        self.chunk_offsets = chunk_offsets
 
 
 class FileDescrip (object):
+
+    inline = None # Absent from patches exported before inline storage
+    
     def __init__(self, db_f):
         self.ftype    = db_f.ftype
         self.name     = db_f.name
@@ -53,6 +65,9 @@ class FileDescrip (object):
             self.size     = db_f.size
             self.file_id  = db_f.file_id
 
+            if db_f.inline is not None:
+                self.inline = db_f.inline
+
         elif db_f.ftype == fs.SYMLINK:
             self.target = db_f.target
 
@@ -87,25 +102,16 @@ def export_patch( filename, patch_num, body_db ):
     if not p.is_complete:
         raise Exception('Patch incomplete. Cannot export')
     
-    store_offset = 0
-    store_len    = 0
-    
-    store_description = list()
+    # The patch's files may span store segments and, once compacted, need
+    # not be adjacent. File ids of content removed by compaction are
+    # skipped
+    dbfs = list( body_db.file_db.files.values( p.starting_file_id, p.ending_file_id ) ) \
+           if p.ending_file_id >= p.starting_file_id else list()
 
-    if p.ending_file_id >= p.starting_file_id:
-    
-        start = body_db.file_db.files[ p.starting_file_id  ]
-        end   = body_db.file_db.files[ p.ending_file_id    ]
-        
-        store_offset = start.offset
-        store_len    = (end.offset - start.offset) + end.zlength
-        
-        i = p.starting_file_id 
-        
-        while i <= p.ending_file_id:
-            dbf = body_db.file_db.files[ i ]
-            store_description.append( StoredFile(dbf.file_id, dbf.offset, dbf.length, dbf.zlength) )
-            i += 1
+    store_len         = sum( dbf.zlength for dbf in dbfs )
+    store_description = [ StoredFile(dbf.file_id, dbf.offset, dbf.length, dbf.zlength,
+                                     dbf.digest, dbf.chunks, dbf.codec, dbf.chunk_offsets)
+                          for dbf in dbfs ]
 
     sd_pickle = pickle.dumps( store_description )
     
@@ -119,8 +125,8 @@ def export_patch( filename, patch_num, body_db ):
         # Store Description Pickle
         f.write( sd_pickle )
 
-        print 'Store offset,len: ', store_offset, store_len
-        body_db.file_store.export_data( f, store_offset, store_len )
+        print 'Store files,len: ', len(dbfs), store_len
+        body_db.file_store.export_files( f, dbfs )
 
         def export_dirs( db_dir ):
             dd_pickle = pickle.dumps( DirDescrip( db_dir ) )
@@ -154,20 +160,30 @@ def import_patch( filename, body_db ):
         store_pickle  = f.read( sd_pickle_len )
         store_description = pickle.loads( store_pickle )
 
+        if sum( sd.zlength for sd in store_description ) != store_len:
+            raise Exception('Patch store data length does not match its description')
+
+        # The data is written to newly allocated store space first. Should
+        # the import fail, the allocations are not committed and the space
+        # is reused
+        locations = body_db.file_store.import_files( f, [ sd.zlength for sd in store_description ] )
+
         sd = None
         
-        for sd in store_description:
-            body_db.file_db.files[ sd.file_id ] = types.DBFile( sd.file_id, sd.offset, sd.length, sd.zlength )
+        for sd, (segment, offset) in zip( store_description, locations ):
+            body_db.file_db.files[ sd.file_id ] = types.DBFile( sd.file_id, offset, sd.length, sd.zlength,
+                                                                sd.digest, sd.chunks, sd.codec, sd.chunk_offsets,
+                                                                segment )
+            if sd.digest is not None:
+                body_db.file_db.index_content( sd.file_id, sd.digest )
 
         if sd:
             body_db.file_db.next_file_id = sd.file_id + 1
 
-        transaction.commit()
+        body_db.commit( True )
 
         store_description = None # no need to keep in memory
 
-        body_db.file_store.import_data( f, store_len )
-
         p = body_db.patch_db.create_patch( body_db )
 
         p.uuid = uuid
@@ -183,7 +199,7 @@ def import_patch( filename, body_db ):
 
             if dd.fq_name == '':
                 _populate( dd, p.root )
-                transaction.commit()
+                body_db.commit( True )
             else:
                 comps = dd.fq_name.split('/')
                 pd    = p.root
@@ -198,10 +214,10 @@ def import_patch( filename, body_db ):
 
                 pd.subdirs[ dir_name ] = new_pd
                 
-                transaction.commit()
+                body_db.commit( True )
 
         p.set_complete(body_db)
-        transaction.commit()
+        body_db.commit( True )
                 
 
 def _populate( dd, db_dir ):
@@ -224,6 +240,9 @@ def _create_patch_file( f, parent ):
     if pf.ftype == fs.REGULAR:
         pf.size     = f.size
         pf.file_id  = f.file_id
+
+        if f.inline is not None:
+            pf.inline = f.inline
         
     elif pf.ftype == fs.SYMLINK:
         pf.target = f.target
@@ -0,0 +1,235 @@
+# Scan filters
+#
+# Rules are matched against paths relative to the scan root, using '/'
+# as the separator (e.g. 'var/log'). Glob rules are split into path
+# components and compiled into a trie. Components may be literal names,
+# fnmatch-style globs or '**', which matches any number of components.
+# As the Scanner descends, the Filter keeps the set of trie nodes that
+# the current directory's path has reached, so matching a name costs one
+# dict lookup plus one test per glob child of each active node,
+# regardless of depth. Regex rules are matched against the full relative
+# path instead and are best kept for patterns globs cannot express.
+#
+# Each rule may:
+#   * exclude or include the matching entries. Excluded entries are
+#     neither added to nor removed from the database; whatever it already
+#     holds for them is left as is. Excluded directories are not
+#     descended into. When several rules match, the last one added wins.
+#   * set the touch_new_only and/or track_files policies of the matching
+#     directories. Policies are inherited by subdirectories.
+#   * apply only to directories (dirs_only, or a glob ending in '/').
+#
+# Rule files hold one rule per line:
+#
+#   exclude    GLOB         include  GLOB
+#   touch-new  GLOB         dirs-only GLOB    (track directories only)
+#   track      GLOB         (reset both policies to the defaults)
+#
+# Prefix the pattern with 're:' for a regex rule. '#' starts a comment.
+#
+import os.path
+import re
+import fnmatch
+
+
+class _Rule (object):
+
+    def __init__(self, index, exclude, touch_new_only, track_files, dirs_only):
+        self.index          = index
+        self.exclude        = exclude          # None, True or False
+        self.touch_new_only = touch_new_only   # None means inherit
+        self.track_files    = track_files      # None means inherit
+        self.dirs_only      = dirs_only
+
+
+
+class _Node (object):
+
+    __slots__ = ('literals', 'globs', 'star', 'is_star', 'rules')
+
+    def __init__(self, is_star = False):
+        self.literals = dict()   # component     => _Node
+        self.globs    = list()   # (regex, _Node)
+        self.star     = None     # '**' child
+        self.is_star  = is_star
+        self.rules    = list()
+
+    def child(self, component):
+        if component == '**':
+            if self.star is None:
+                self.star = _Node( True )
+            return self.star
+
+        if not any( c in component for c in '*?[' ):
+            if not component in self.literals:
+                self.literals[ component ] = _Node()
+            return self.literals[ component ]
+
+        rx = re.compile( fnmatch.translate( component ) )
+        for r, n in self.globs:
+            if r.pattern == rx.pattern:
+                return n
+        n = _Node()
+        self.globs.append( (rx, n) )
+        return n
+
+
+
+def _closure( nodes ):
+    out = list()
+    for n in nodes:
+        while n is not None and not n in out:
+            out.append( n )
+            n = n.star
+    return out
+
+
+def _step( states, name ):
+    nxt = list()
+    for n in states:
+        if n.is_star:
+            nxt.append( n )
+        c = n.literals.get( name )
+        if c is not None:
+            nxt.append( c )
+        for rx, c in n.globs:
+            if rx.match( name ):
+                nxt.append( c )
+    return _closure( nxt )
+
+
+
+class Filter (object):
+
+    def __init__(self):
+        self.touch_new_only = False
+        self.track_files    = True
+
+        self.ignore_dirs    = set() # Absolute paths. Used for mount points
+
+        self.root           = _Node()
+        self.regexes        = list() # (regex, _Rule)
+        self.nrules         = 0
+        self.has_excludes   = False
+
+        self.states         = None   # Trie nodes reached by the current directory
+        self.path           = None   # Current directory relative to the scan root
+        self.stack          = list()
+
+
+    def add_ignore(self, path):
+        self.ignore_dirs.add( path )
+
+
+    def add_rule(self, pattern, regex = False, exclude = None, touch_new_only = None,
+                 track_files = None, dirs_only = False):
+
+        rule = _Rule( self.nrules, exclude, touch_new_only, track_files, dirs_only )
+        self.nrules += 1
+
+        if exclude is not None:
+            self.has_excludes = True
+
+        if regex:
+            # Anchored at the end, as fnmatch.translate() does for globs,
+            # so that 're:var/log' does not also match 'var/logrotate.d'
+            self.regexes.append( (re.compile( '(?:%s)\\Z' % pattern ), rule) )
+            return
+
+        if pattern.endswith('/'):
+            rule.dirs_only = True
+
+        n = self.root
+        for c in pattern.strip('/').split('/'):
+            if c:
+                n = n.child( c )
+        n.rules.append( rule )
+
+
+    def exclude(self, pattern, regex = False, dirs_only = False):
+        self.add_rule( pattern, regex, exclude = True, dirs_only = dirs_only )
+
+    def include(self, pattern, regex = False, dirs_only = False):
+        self.add_rule( pattern, regex, exclude = False, dirs_only = dirs_only )
+
+    def add_touch_new_files(self, pattern, regex = False):
+        self.add_rule( pattern, regex, touch_new_only = True, track_files = True, dirs_only = True )
+
+    def add_track_dirs_only(self, pattern, regex = False):
+        self.add_rule( pattern, regex, touch_new_only = False, track_files = False, dirs_only = True )
+
+    def add_track_files(self, pattern, regex = False):
+        self.add_rule( pattern, regex, touch_new_only = False, track_files = True, dirs_only = True )
+
+
+    def load_rules(self, filename):
+        actions = { 'exclude'   : self.exclude,
+                    'include'   : self.include,
+                    'touch-new' : self.add_touch_new_files,
+                    'dirs-only' : self.add_track_dirs_only,
+                    'track'     : self.add_track_files }
+
+        with open( filename ) as f:
+            for lineno, line in enumerate(f):
+                line = line.split('#', 1)[0].strip()
+                if not line:
+                    continue
+                p = line.split(None, 1)
+                if len(p) != 2 or not p[0] in actions:
+                    raise Exception('Invalid filter rule at %s:%d: %s' % (filename, lineno + 1, line))
+                if p[1].startswith('re:'):
+                    actions[ p[0] ]( p[1][3:], regex = True )
+                else:
+                    actions[ p[0] ]( p[1] )
+
+
+    def _matching_rules(self, states, path, is_dir):
+        rules = [ r for n in states for r in n.rules if is_dir or not r.dirs_only ]
+
+        for rx, r in self.regexes:
+            if (is_dir or not r.dirs_only) and rx.match( path ):
+                rules.append( r )
+
+        if len(rules) > 1:
+            rules.sort( key = lambda r: r.index )
+
+        return rules
+
+
+    def _join(self, name):
+        return name if not self.path else self.path + '/' + name
+
+
+    # True if the named entry of the current directory is excluded
+    def excluded(self, name, is_dir):
+        if not self.has_excludes:
+            return False
+
+        ex = False
+        for r in self._matching_rules( _step( self.states, name ), self._join( name ), is_dir ):
+            if r.exclude is not None:
+                ex = r.exclude
+        return ex
+
+
+    def push_dir(self, dir_name):
+        self.stack.append( (self.states, self.path, self.touch_new_only, self.track_files) )
+
+        if self.states is None:
+            # Scan root
+            self.states = _closure( [self.root] )
+            self.path   = ''
+            return
+
+        self.path   = self._join( dir_name )
+        self.states = _step( self.states, dir_name )
+
+        for r in self._matching_rules( self.states, self.path, True ):
+            if r.touch_new_only is not None:
+                self.touch_new_only = r.touch_new_only
+            if r.track_files is not None:
+                self.track_files = r.track_files
+
+
+    def pop_dir(self):
+        self.states, self.path, self.touch_new_only, self.track_files = self.stack.pop()
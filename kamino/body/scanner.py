@@ -1,10 +1,15 @@
 import os
 import os.path
 import subprocess
+import threading
+import Queue
+import sys
 
 from kamino.body import fs
 from kamino.body import db
 
+from kamino.body.path_filter import Filter
+
 
 
 class Delta (object):
@@ -32,72 +37,254 @@ class Delta (object):
     def directory_added(self, fs_dir):
         pass
 
+    # Called from within a directory once its listing has been fully
+    # processed. fs_dir is the stat of the directory taken before it was
+    # listed
+    def directory_scanned(self, fs_dir):
+        pass
 
-class Filter (object):
 
-    def __init__(self):
-        self.touch_new_only = False
-        self.track_files    = True
+class DirReader (object):
 
-        self.ignore_dirs = set()
+    def prefetch(self, path):
+        pass
 
-        self.filters = dict()
-        self.dstack  = list()
-        self.fstack  = list()
+    def read(self, path):
+        return fs.read_dir( path )
 
-        
-    def add_ignore(self, path):
-        self.ignore_dirs.add( path )
+    def close(self):
+        pass
 
-    def add_touch_new_files(self, path):
-        self.filters[ path ] = (True, True)
 
-    def add_track_dirs_only(self, path):
-        self.filters[ path ] = (False, False)
 
-    def push_dir(self, dir_name):
-        self.dstack.append( dir_name )
+class _PendingRead (object):
+
+    QUEUED  = 0
+    CLAIMED = 1
+    DONE    = 2
+
+    def __init__(self, path):
+        self.path     = path
+        self.state    = _PendingRead.QUEUED
+        self.lock     = threading.Lock()
+        self.done     = threading.Event()
+        self.content  = None
+        self.exc_info = None
+
+    # Returns True if the caller now owns the read
+    def claim(self):
+        with self.lock:
+            if self.state == _PendingRead.QUEUED:
+                self.state = _PendingRead.CLAIMED
+                return True
+            return False
+
+    def run(self):
+        try:
+            self.content = fs.read_dir( self.path )
+        except Exception:
+            self.exc_info = sys.exc_info()
+        self.state = _PendingRead.DONE
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.content
+
+
+
+class ParallelDirReader (object):
+
+    # Reads directories on a pool of worker threads ahead of the
+    # Scanner. Requests are served last-in-first-out so the workers
+    # follow the depth-first order in which the Scanner consumes them.
+    # Only the reads are parallel; all Delta callbacks still happen on
+    # the scanning thread.
+
+    def __init__(self, num_workers, max_pending = 4096):
+        self.max_pending = max_pending
+        self.pending     = dict()
+        self.requests    = Queue.LifoQueue()
+        self.workers     = list()
+
+        for i in range(num_workers):
+            t = threading.Thread( target = self._work )
+            t.daemon = True
+            t.start()
+            self.workers.append( t )
+
+    def _work(self):
+        while True:
+            p = self.requests.get()
+            if p is None:
+                return
+            if p.claim():
+                p.run()
+
+    def prefetch(self, path):
+        if path in self.pending or len(self.pending) >= self.max_pending:
+            return
+        p = _PendingRead( path )
+        self.pending[ path ] = p
+        self.requests.put( p )
 
-        p = os.path.join(*self.dstack)
-        
-        t = (self.touch_new_only, self.track_files)
-        self.fstack.append( t )
-        
-        self.touch_new_only, self.track_files = self.filters.get( p, t )
-        
-        print 'FILT ', dir_name, self.touch_new_only, self.track_files
+    def read(self, path):
+        p = self.pending.pop( path, None )
 
-    def pop_dir(self):
-        self.touch_new_only, self.track_files = self.fstack.pop()
-        self.dstack.pop()
-        
+        if p is None:
+            return fs.read_dir( path )
 
-    
-class Scanner (object):
+        if p.claim():
+            # Not started yet. Cheaper to read it here than to wait
+            p.run()
+
+        return p.wait()
 
-    def __init__(self, root_fs_dir, body_db, delta, filter_obj):
+    def close(self):
+        for t in self.workers:
+            self.requests.put( None )
+        for t in self.workers:
+            t.join()
+        self.workers = list()
+        self.pending.clear()
 
-        self.fs_id_map  = dict()
-        self.filter     = filter_obj
-        self.fs_root    = root_fs_dir
-        self.body_db    = body_db
-        self.delta      = delta
+
+
+class Scanner (object):
+
+    # In incremental mode, directories whose inode, mtime and ctime match
+    # the values recorded by the last scan are not listed; only their
+    # known subdirectories are visited. Entries added to or removed from
+    # such a directory always change its mtime, but in-place content
+    # modifications and metadata changes of the files within it do not
+    # and will not be detected.
+    #
+    # If a watcher.Journal is supplied, only the directories it recorded
+    # as dirty are listed and only the paths leading to them are
+    # visited. An overflowed journal results in a full scan.
+    
+    def __init__(self, root_fs_dir, body_db, delta, filter_obj, num_workers=1, incremental=False,
+                 journal=None):
+
+        self.dev_map      = dict() # st_dev => fs_id
+        self.filter       = filter_obj
+        self.fs_root      = os.path.abspath( root_fs_dir )
+        self.body_db      = body_db
+        self.delta        = delta
+        self.num_workers  = num_workers
+        self.incremental  = incremental
+        self.journal      = journal
+        self.dirty_dirs   = None # Directories to list. None means all
+        self.visit_dirs   = None # Directories leading to dirty_dirs
+        self.reader       = None
+        self.listed_dirs  = 0
+        self.skipped_dirs = 0
 
         
         
     def scan(self, ignore_mounts=True):
 
+        self._prepare( ignore_mounts )
+                    
+        self.reader = self._make_reader()
+
+        try:
+            self.recursive_scan( self.fs_root, self.body_db.db_root['/'],
+                                 fs_dir = fs.stat_file( self.fs_root ) )
+        finally:
+            self.reader.close()
+            self.reader = None
+
+        if self.journal is not None:
+            self.journal.clear()
+
+        if self.incremental or self.dirty_dirs is not None:
+            print 'SCAN: listed %d directories, skipped %d unchanged' % (self.listed_dirs, self.skipped_dirs)
+
+
+    def _prepare(self, ignore_mounts):
         # Ensure our mount points and skip dirs are up to date
         
-        for mount_point, fs_id in self.body_db.fs_db.mounts.iteritems():
-            self.fs_id_map[ mount_point ] = fs_id
+        self._build_dev_map()
 
         if ignore_mounts:
-            for mount, is_local in fs.get_mount_table().iteritems():
-                if not is_local:
-                    self.filter.add_ignore( mount )
+            for m in fs.mounts.get_mount_table():
+                if not m.is_local:
+                    self.filter.add_ignore( m.mount_point )
                     
-        self.recursive_scan( self.fs_root, self.body_db.db_root['/'] )
+        if self.journal is not None:
+            self._load_journal()
+
+
+    def _make_reader(self):
+        if self.num_workers > 1:
+            return ParallelDirReader( self.num_workers )
+        else:
+            return DirReader()
+
+
+    def _load_journal(self):
+        overflowed, dirty = self.journal.consume()
+
+        if overflowed:
+            print 'SCAN: change journal overflowed. Performing a full scan'
+            self.dirty_dirs = None
+            self.visit_dirs = None
+            return
+
+        prefix = self.fs_root.rstrip('/') + '/'
+        
+        self.dirty_dirs = set( d for d in dirty if d == self.fs_root or d.startswith( prefix ) )
+        self.visit_dirs = set()
+
+        for d in self.dirty_dirs:
+            while d != self.fs_root and not d in self.visit_dirs:
+                self.visit_dirs.add( d )
+                d = os.path.dirname( d )
+
+        
+    def _build_dev_map(self):
+        mounts = self.body_db.fs_db.mounts
+        
+        self.dev_map.clear()
+
+        for dev, m in fs.mounts.get_mount_table().by_dev.iteritems():
+            if m.mount_point in mounts:
+                self.dev_map[ dev ] = mounts[ m.mount_point ]
+
+                
+    def _get_fs_id(self, fs_f):
+        fs_id = self.dev_map.get( fs_f.dev )
+
+        if fs_id is not None:
+            return fs_id
+
+        # Either mounted since the scan started or a device that does not
+        # appear in the mount table (e.g. a btrfs subvolume). Register new
+        # mounts, then fall back to the innermost tracked mount point
+        # containing the file. The result is cached for the device.
+        if not self.body_db.read_only:
+            self.body_db.fs_db.check_filesystems()
+        self._build_dev_map()
+
+        fs_id = self.dev_map.get( fs_f.dev )
+        
+        if fs_id is None:
+            mounts = self.body_db.fs_db.mounts
+            p = os.path.dirname( fs_f.fq_name )
+            while not p in mounts and p != '/':
+                p = os.path.dirname( p )
+            fs_id = mounts.get( p )
+
+        # Read-only scans cannot register new filesystems
+        if fs_id is None and not self.body_db.read_only:
+            raise Exception('No tracked filesystem contains %s' % fs_f.fq_name)
+
+        self.dev_map[ fs_f.dev ] = fs_id
+
+        return fs_id
 
         
     def _push_dir(self, dir_name):
@@ -108,56 +295,92 @@ class Scanner (object):
         self.filter.pop_dir()
         self.delta.pop_dir()
 
+    # Must be called with the subdirectory paths in the order they will
+    # be scanned
+    def _prefetch(self, paths):
+        for p in reversed(paths):
+            if not p in self.filter.ignore_dirs:
+                self.reader.prefetch( p )
+
+    # Paths of the (fs_dir, db_dir) pairs that will need to be listed
+    def _to_list(self, fs_dir_path, dir_pairs):
+        l = list()
+        for fs_f, db_f in dir_pairs:
+            p = os.path.join( fs_dir_path, fs_f.name )
+            if not self._is_unchanged( p, fs_f, db_f ):
+                l.append( p )
+        return l
+
+    # Drops the entries of the current directory excluded by the filter
+    def _filtered(self, content):
+        if self.filter.has_excludes:
+            for name in [ f.name for f in content.itervalues()
+                          if self.filter.excluded( f.name, f.ftype == fs.DIRECTORY ) ]:
+                del content[ name ]
+        return content
 
+    def _is_unchanged(self, fs_dir_path, fs_dir, db_dir):
+        if self.dirty_dirs is not None:
+            return not fs_dir_path in self.dirty_dirs
+        return self.incremental and fs_dir is not None and db_dir.stat_matches( fs_dir )
 
-    def recursive_scan(self, fs_dir_path, db_dir, fs_id=None ):
+    # False for existing directories that cannot lead to a change
+    def _should_visit(self, fs_dir_path):
+        return self.visit_dirs is None or fs_dir_path in self.visit_dirs
+
+
+
+    def recursive_scan(self, fs_dir_path, db_dir, fs_dir=None ):
 
         if fs_dir_path in self.filter.ignore_dirs:
             return
 
         self._push_dir( db_dir.name )
         
-        if fs_id is None:
-            mounts = self.fs_id_map.keys()
-            mounts.sort()
-            mounts.reverse()
-            for mp in mounts:
-                if fs_dir_path.startswith( mp ):
-                    fs_id = self.fs_id_map[ mp ]
-                    break
-
-        if fs_dir_path in self.fs_id_map:
-            fs_id = self.fs_id_map[ fs_dir_path ]
-
-        assert fs_id is not None
-
-        fs_content = fs.read_dir( fs_dir_path )
-
-        fs_set = set( (f.name, f.ftype) for f in fs_content.itervalues() )
-        db_set = db_dir.get_content_set()
-
-        removed = [ db_dir.content[ t[0] ] for t in db_set.difference( fs_set ) ]
-        added   = [ fs_content[ t[0] ]     for t in fs_set.difference( db_set ) ]
-        same    = [ (fs_content[t[0]], db_dir.content[t[0]]) for t in db_set.intersection( fs_set ) ]
-
-        # Remove modified files & symlinks from 'same'
-        if self.filter.track_files and not self.filter.touch_new_only:
-            for tpl in same:
-                fs_f, db_f = tpl
-                if (fs_f.ftype == fs.SYMLINK and fs_f.target   != db_f.target  ) or (
-                    fs_f.ftype == fs.REGULAR and fs_f.mtime_ns != db_f.mtime_ns):
-                    same.remove( tpl )
-                    removed.append( db_f )
-                    added.append( fs_f )
+        if self._is_unchanged( fs_dir_path, fs_dir, db_dir ):
+            self.skipped_dirs += 1
+            self.scan_known_subdirs( fs_dir_path, db_dir )
+            self._pop_dir()
+            return
+
+        self.listed_dirs += 1
         
+        fs_content = self._filtered( self.reader.read( fs_dir_path ) )
 
+        # Single pass over both listings. Entries whose type changed are
+        # treated as a removal plus an addition, as are modified regular
+        # files and retargeted symlinks
+        check_content = self.filter.track_files and not self.filter.touch_new_only
+        db_content    = db_dir.content
+        
+        removed       = list()
+        added         = list()
+        same          = list()
         meta_modified = list()
-        for tpl in same:
-            fs_f, db_f = tpl
-            if (fs_f.uid, fs_f.gid, fs_f.mode) != (
-                db_f.uid, db_f.gid, db_f.mode):
-                if self.filter.track_files or fs_f.ftype == fs.DIRECTORY:
-                    meta_modified.append( tpl )
+
+        for name, fs_f in fs_content.iteritems():
+            db_f = db_content.get( name )
+
+            if db_f is None:
+                added.append( fs_f )
+                
+            elif db_f.ftype != fs_f.ftype or (check_content and (
+                (fs_f.ftype == fs.REGULAR and fs_f.mtime_ns != db_f.mtime_ns) or
+                (fs_f.ftype == fs.SYMLINK and fs_f.target   != db_f.target  ))):
+                removed.append( db_f )
+                added.append( fs_f )
+                
+            else:
+                same.append( (fs_f, db_f) )
+                
+                if (fs_f.uid, fs_f.gid, fs_f.mode) != (db_f.uid, db_f.gid, db_f.mode):
+                    if self.filter.track_files or fs_f.ftype == fs.DIRECTORY:
+                        meta_modified.append( (fs_f, db_f) )
+
+        if len(fs_content) - len(added) != len(db_content) - len(removed):
+            for name, db_f in db_content.iteritems():
+                if not name in fs_content and not self.filter.excluded( name, db_f.ftype == fs.DIRECTORY ):
+                    removed.append( db_f )
 
         # process order:
         #   1. Non-directory Removals
@@ -175,7 +398,7 @@ class Scanner (object):
 
             for fs_f in (x for x in added if not x.ftype == fs.DIRECTORY):
                 if fs_f.ftype == fs.REGULAR:
-                    fs_f.fs_id = fs_id
+                    fs_f.fs_id = self._get_fs_id( fs_f )
                 self.delta.content_added( fs_f, self.filter.touch_new_only )
             
             
@@ -184,22 +407,54 @@ class Scanner (object):
             self.delta.metadata_changed(db_file, fs_file)
     
 
+        added_dirs = [ x for x in added if x.ftype == fs.DIRECTORY ]
+        same_dirs  = [ x for x in same  if x[0].ftype == fs.DIRECTORY and
+                       self._should_visit( os.path.join(fs_dir_path, x[0].name) ) ]
+
+        self._prefetch( [ os.path.join(fs_dir_path, x.name) for x in added_dirs ] +
+                        self._to_list( fs_dir_path, same_dirs ) )
+
         for db_f in (x for x in removed if x.ftype == fs.DIRECTORY):
             self.recursive_remove( db_f )
 
             
-        for fs_f in (x for x in added if x.ftype == fs.DIRECTORY):
-            self.recursive_add( fs_dir_path, fs_f, fs_id )
+        for fs_f in added_dirs:
+            self.recursive_add( fs_dir_path, fs_f )
 
             
-        for tpl in same:
-            if tpl[0].ftype == fs.DIRECTORY:
-                self.recursive_scan( os.path.join(fs_dir_path, tpl[0].name), tpl[1], fs_id )
+        if fs_dir is not None:
+            self.delta.directory_scanned( fs_dir )
+            
+        for tpl in same_dirs:
+            self.recursive_scan( os.path.join(fs_dir_path, tpl[0].name), tpl[1], tpl[0] )
 
         self._pop_dir()
 
 
 
+    # Used in place of listing a directory that has not changed since the
+    # last scan. Its subdirectories must still exist, so stat them
+    # directly and recurse.
+    def scan_known_subdirs(self, fs_dir_path, db_dir):
+        same_dirs = list()
+        
+        for db_f in db_dir.content.itervalues():
+            if db_f.ftype == fs.DIRECTORY and not self.filter.excluded( db_f.name, True ):
+                path = os.path.join(fs_dir_path, db_f.name)
+                if self._should_visit( path ):
+                    same_dirs.append( (fs.stat_file( path ), db_f) )
+
+        for fs_f, db_f in same_dirs:
+            if (fs_f.uid, fs_f.gid, fs_f.mode) != (db_f.uid, db_f.gid, db_f.mode):
+                self.delta.metadata_changed( db_f, fs_f )
+
+        self._prefetch( self._to_list( fs_dir_path, same_dirs ) )
+
+        for fs_f, db_f in same_dirs:
+            self.recursive_scan( os.path.join(fs_dir_path, fs_f.name), db_f, fs_f )
+
+
+
 
     def recursive_remove(self, db_dir):
         # Bottom up, recurse to lower directories first
@@ -218,31 +473,36 @@ class Scanner (object):
 
 
     
-    def recursive_add(self, fs_dir_path, fs_f, fs_id):
+    def recursive_add(self, fs_dir_path, fs_f):
         # Top down, recurse to lower directories last
+
+        path = os.path.join( fs_dir_path, fs_f.name )
     
-        if fs_dir_path in self.filter.ignore_dirs:
+        if path in self.filter.ignore_dirs:
             return
 
         self.delta.directory_added( fs_f )
 
         self._push_dir( fs_f.name )
-        
-        if fs_dir_path in self.fs_id_map:
-            fs_id = self.fs_id_map[ fs_dir_path ]
-    
-        path = os.path.join( fs_dir_path, fs_f.name )
+
+        self.listed_dirs += 1
     
-        content = fs.read_dir( path )
+        content = self._filtered( self.reader.read( path ) )
 
         if self.filter.track_files:
             for f in ( x for x in content.itervalues() if not x.ftype == fs.DIRECTORY ):
                 if f.ftype == fs.REGULAR:
-                    f.fs_id = fs_id
+                    f.fs_id = self._get_fs_id( f )
                 self.delta.content_added( f, self.filter.touch_new_only )
+
+        subdirs = [ x for x in content.itervalues() if x.ftype == fs.DIRECTORY ]
+
+        self._prefetch( [ os.path.join(path, x.name) for x in subdirs ] )
             
-        for f in ( x for x in content.itervalues() if x.ftype == fs.DIRECTORY ):
-            self.recursive_add( path, f, fs_id )
+        for f in subdirs:
+            self.recursive_add( path, f )
+
+        self.delta.directory_scanned( fs_f )
 
         self._pop_dir()
 
@@ -0,0 +1,440 @@
+# Multi-process scanning
+#
+# ShardedScanner splits the tree below the scan root into shards: one for
+# each top-level directory already in the database plus one for each
+# tracked local mount point deeper in the tree. Before the scan starts it
+# forks num_procs worker processes and deals the shards out to them.
+# Each worker opens its own read-only BodyDB and runs an ordinary Scanner
+# over each of its shards, recording the Delta callbacks and shipping
+# them back to the parent in batches over a pipe.
+#
+# The parent scans the root directory itself. When it reaches a shard it
+# replays the shard's events, in order, into the real Delta, followed by
+# the events of any mount point shards nested within it. Database
+# objects are passed back by name and resolved against the parent's own
+# connection, so the Delta (DBUpdater, PatchCreator, ...) runs unchanged
+# on the parent. Shards the parent does not reach, because the directory
+# was removed or excluded, are discarded.
+#
+# Workers see the database as last committed, so nothing must be
+# committed below the root while they run. Removed and changed entries
+# are only ever reported for directories the workers found in the
+# database, so the parent can always resolve them.
+#
+# ZODB only writes the FileStorage index on close, and a read-only open
+# of a stale index ignores it and rebuilds the index by reading the whole
+# .zodb file. The parent therefore commits and saves the index before
+# forking so that each worker's open only loads it.
+#
+# With a change journal, the parent consumes it before forking and the
+# workers scan only the dirty directories within their shards. Shards
+# holding no dirty directories are not scanned at all.
+#
+import os
+import os.path
+import struct
+import select
+import signal
+import cPickle
+import traceback
+import multiprocessing
+
+from kamino.body         import fs
+from kamino.body         import db
+from kamino.body.scanner import Delta, Scanner
+
+
+BATCH_SIZE = 1000
+
+_header = struct.Struct('!I')
+
+
+def _write_msg( fd, msg ):
+    data = cPickle.dumps( msg, 2 )
+    data = _header.pack( len(data) ) + data
+    while data:
+        data = data[ os.write( fd, data ): ]
+
+
+
+class _ShardRecorder (Delta):
+
+    # Database objects are recorded by name. They are looked up relative to
+    # the current directory when the events are replayed
+
+    def __init__(self, fd, index):
+        self.fd     = fd
+        self.index  = index
+        self.events = list()
+
+    def _add(self, *event):
+        self.events.append( event )
+        if len(self.events) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.events:
+            _write_msg( self.fd, (self.index, 'events', self.events) )
+            self.events = list()
+
+    def push_dir(self, dir_name):
+        self._add( 'push_dir', dir_name )
+
+    def pop_dir(self):
+        self._add( 'pop_dir' )
+
+    def content_added(self, fs_file, force_zero_length=False):
+        self._add( 'content_added', fs_file, force_zero_length )
+
+    def content_removed(self, db_file):
+        self._add( 'content_removed', db_file.name )
+
+    def metadata_changed(self, db_file, fs_file):
+        self._add( 'metadata_changed', db_file.name, fs_file )
+
+    def directory_removed(self, db_dir):
+        self._add( 'directory_removed', db_dir.name )
+
+    def directory_added(self, fs_dir):
+        self._add( 'directory_added', fs_dir )
+
+    def directory_scanned(self, fs_dir):
+        self._add( 'directory_scanned', fs_dir )
+
+
+
+class _Shard (object):
+
+    def __init__(self, index, path, components):
+        self.index      = index
+        self.path       = path
+        self.components = components # Path components relative to the scan root
+        self.nested     = list()     # Mount point shards within this one
+        self.batches    = list()
+        self.done       = False
+        self.error      = None
+
+
+
+class _Worker (object):
+
+    def __init__(self, pid, fd, shards):
+        self.pid    = pid
+        self.fd     = fd
+        self.shards = shards
+        self.buf    = ''
+
+
+
+class ShardedScanner (Scanner):
+
+    def __init__(self, root_fs_dir, body_db, delta, filter_obj, num_procs=None, num_workers=1,
+                 incremental=False, journal=None):
+
+        Scanner.__init__( self, root_fs_dir, body_db, delta, filter_obj, num_workers, incremental,
+                          journal )
+
+        self.num_procs = num_procs or multiprocessing.cpu_count()
+        self.shards    = dict() # path => _Shard. Only shards the parent scans directly
+        self.by_index  = list()
+        self.workers   = list()
+
+
+    def scan(self, ignore_mounts=True):
+        try:
+            Scanner.scan( self, ignore_mounts )
+        finally:
+            self._stop_workers()
+
+        print 'SCAN: %d shards on %d processes' % (len(self.by_index), len(self.workers))
+
+
+    def _prepare(self, ignore_mounts):
+        Scanner._prepare( self, ignore_mounts )
+
+        self._find_shards()
+
+        # Fork before any reader threads exist
+        if self.by_index:
+            self._start_workers()
+
+
+    def _lookup_db_dir(self, body_db, components):
+        d = body_db.lookup( '/'.join( components ) )
+        if d is None or d.ftype != fs.DIRECTORY:
+            return None
+        return d
+
+
+    def _find_shards(self):
+        ignored = self.filter.ignore_dirs
+        prefix  = self.fs_root.rstrip('/') + '/'
+
+        for name, d in self.body_db.db_root['/'].content.iteritems():
+            path = prefix + name
+            if d.ftype == fs.DIRECTORY and not path in ignored and self._should_visit( path ):
+                self._add_shard( path, [name] )
+
+        tracked = self.body_db.fs_db.mounts
+        mps     = [ m.mount_point for m in fs.mounts.get_mount_table()
+                    if m.is_local and m.mount_point in tracked and not m.mount_point in ignored and
+                       self._should_visit( m.mount_point ) ]
+
+        for mp in sorted( mps ):
+            components = mp[ len(prefix): ].split('/')
+            if not mp.startswith( prefix ) or len(components) < 2 or \
+               self._lookup_db_dir( self.body_db, components ) is None:
+                continue
+
+            top = self.shards.get( prefix + components[0] )
+            if top is not None:
+                top.nested.append( self._add_shard( mp, components, False ) )
+
+
+    def _add_shard(self, path, components, top_level = True):
+        shard = _Shard( len(self.by_index), path, components )
+        self.by_index.append( shard )
+        if top_level:
+            self.shards[ path ] = shard
+        return shard
+
+
+    def _start_workers(self):
+        nprocs = min( self.num_procs, len(self.by_index) )
+
+        self.body_db.save_index()
+
+        for i in range(nprocs):
+            shards = self.by_index[ i :: nprocs ]
+
+            rfd, wfd = os.pipe()
+
+            pid = os.fork()
+
+            if pid == 0:
+                os.close( rfd )
+                for w in self.workers:
+                    os.close( w.fd )
+                self._run_worker( shards, wfd )
+
+            os.close( wfd )
+            self.workers.append( _Worker( pid, rfd, shards ) )
+
+
+    def _stop_workers(self):
+        for w in self.workers:
+            if w.fd is not None:
+                os.close( w.fd )
+                w.fd = None
+            if w.pid is not None:
+                try:
+                    os.kill( w.pid, signal.SIGTERM )
+                except OSError:
+                    pass
+                os.waitpid( w.pid, 0 )
+                w.pid = None
+
+
+    # Runs in the forked child. Never returns
+    def _run_worker(self, shards, fd):
+        status = 0
+        index  = shards[0].index
+        try:
+            body_db = db.BodyDB( self.body_db.db_dir, read_only = True )
+
+            for shard in shards:
+                index = shard.index
+                listed, skipped = self._scan_shard( body_db, shard, fd )
+                _write_msg( fd, (index, 'done', (listed, skipped)) )
+        except:
+            status = 1
+            try:
+                _write_msg( fd, (index, 'error', traceback.format_exc()) )
+            except Exception:
+                pass
+        os._exit( status )
+
+
+    def _scan_shard(self, body_db, shard, fd):
+        rec  = _ShardRecorder( fd, shard.index )
+        s    = Scanner( self.fs_root, body_db, rec, self.filter, self.num_workers, self.incremental )
+
+        s.dev_map    = self.dev_map
+        s.dirty_dirs = self.dirty_dirs # From the parent's journal, if any
+        s.visit_dirs = self.visit_dirs
+
+        for n in shard.nested:
+            self.filter.add_ignore( n.path )
+
+        # Bring the filter to the shard's parent directory
+        self.filter.push_dir( '' )
+        depth = 1
+
+        try:
+            for c in shard.components[:-1]:
+                if self.filter.excluded( c, True ):
+                    return 0, 0
+                self.filter.push_dir( c )
+                depth += 1
+
+            db_dir = self._lookup_db_dir( body_db, shard.components )
+
+            if db_dir is None or self.filter.excluded( shard.components[-1], True ):
+                return 0, 0
+
+            try:
+                fs_dir = fs.stat_file( shard.path )
+            except OSError:
+                return 0, 0
+
+            if fs_dir.ftype != fs.DIRECTORY:
+                return 0, 0
+
+            s.reader = s._make_reader()
+            try:
+                s.recursive_scan( shard.path, db_dir, fs_dir )
+            finally:
+                s.reader.close()
+
+            rec.flush()
+
+            return s.listed_dirs, s.skipped_dirs
+
+        finally:
+            for i in range(depth):
+                self.filter.pop_dir()
+            for n in shard.nested:
+                self.filter.ignore_dirs.discard( n.path )
+
+
+    # Reads whatever the workers have sent so far. Blocks until at least
+    # one message arrives
+    def _receive(self):
+        fds = dict( (w.fd, w) for w in self.workers if w.fd is not None )
+
+        ready, _, _ = select.select( fds.keys(), [], [] )
+
+        for fd in ready:
+            w    = fds[ fd ]
+            data = os.read( fd, 1024 * 1024 )
+
+            if not data:
+                os.close( fd )
+                w.fd = None
+                for shard in w.shards:
+                    if not shard.done:
+                        shard.error = 'Worker process %d exited' % w.pid
+                        shard.done  = True
+                continue
+
+            w.buf += data
+
+            while len(w.buf) >= _header.size:
+                n = _header.unpack_from( w.buf )[0]
+                if len(w.buf) < _header.size + n:
+                    break
+                index, kind, payload = cPickle.loads( w.buf[ _header.size : _header.size + n ] )
+                w.buf = w.buf[ _header.size + n : ]
+
+                shard = self.by_index[ index ]
+
+                if kind == 'events':
+                    shard.batches.append( payload )
+                elif kind == 'done':
+                    self.listed_dirs  += payload[0]
+                    self.skipped_dirs += payload[1]
+                    shard.done = True
+                else:
+                    shard.error = payload
+                    shard.done  = True
+
+
+    # dirs is the replay-side stack of database directories, innermost
+    # last. It holds None for directories not (yet) in the database
+    def _apply_shard(self, shard, dirs):
+        i = 0
+        while True:
+            while i < len(shard.batches):
+                self._replay( shard.batches[i], dirs )
+                shard.batches[i] = None
+                i += 1
+
+            if shard.done:
+                break
+
+            self._receive()
+
+        shard.batches = list()
+
+        if shard.error:
+            raise Exception('Scan of shard %s failed:\n%s' % (shard.path, shard.error))
+
+
+    # The Delta may or may not have written a newly added directory into
+    # the database by the time it is entered (DiffDelta never does) so
+    # anything below an added directory is resolved to None
+    @staticmethod
+    def _child_dir(db_dir, name):
+        if db_dir is None:
+            return None
+        d = db_dir.content.get( name )
+        if d is None or d.ftype != fs.DIRECTORY:
+            return None
+        return d
+
+
+    def _replay(self, events, dirs):
+        delta = self.delta
+
+        for e in events:
+            name = e[0]
+
+            if name == 'push_dir':
+                delta.push_dir( e[1] )
+                dirs.append( self._child_dir( dirs[-1], e[1] ) )
+
+            elif name == 'pop_dir':
+                delta.pop_dir()
+                dirs.pop()
+
+            elif name == 'content_added':
+                fs_f = e[1]
+                if fs_f.ftype == fs.REGULAR:
+                    # Workers cannot register new filesystems
+                    fs_f.fs_id = self._get_fs_id( fs_f )
+                delta.content_added( fs_f, e[2] )
+
+            elif name == 'content_removed':
+                delta.content_removed( dirs[-1].content[ e[1] ] )
+
+            elif name == 'metadata_changed':
+                delta.metadata_changed( dirs[-1].content[ e[1] ], e[2] )
+
+            elif name == 'directory_removed':
+                delta.directory_removed( dirs[-1].content[ e[1] ] )
+
+            else:
+                getattr( delta, name )( e[1] )
+
+
+    def recursive_scan(self, fs_dir_path, db_dir, fs_dir=None):
+        shard = self.shards.get( fs_dir_path )
+
+        if shard is None or fs_dir_path in self.filter.ignore_dirs:
+            return Scanner.recursive_scan( self, fs_dir_path, db_dir, fs_dir )
+
+        self._apply_shard( shard, [ db_dir.parent ] )
+
+        # Mount points within the shard, entered from the scan root
+        for n in shard.nested:
+            dirs = [ db_dir.parent ]
+            for c in n.components[:-1]:
+                self.delta.push_dir( c )
+                dirs.append( self._child_dir( dirs[-1], c ) )
+            self._apply_shard( n, dirs )
+            for c in n.components[:-1]:
+                self.delta.pop_dir()
+
+
+    def _prefetch(self, paths):
+        Scanner._prefetch( self, [ p for p in paths if not p in self.shards ] )
@@ -0,0 +1,225 @@
+# Change journal for incremental scans.
+#
+# The Watcher uses inotify to record the directories whose listing or
+# content changed into a Journal file. A Scanner given the Journal then
+# visits only those directories (and the path down to them) instead of
+# the whole tree.
+#
+# Journal file format: one escaped directory path per line. A line
+# holding only OVERFLOW means events were lost and the next scan must be
+# a full one. Watcher appends under an flock; the Scanner moves the
+# entries into a snapshot file before scanning and deletes the snapshot
+# only after the scan completes, so entries survive a failed scan.
+#
+import os
+import os.path
+import errno
+import fcntl
+import select
+import optparse
+
+from kamino.body.fs import cwrap
+
+
+OVERFLOW = '*'
+
+
+class Journal (object):
+
+    def __init__(self, journal_fn):
+        self.journal_fn  = journal_fn
+        self.snapshot_fn = journal_fn + '.scanning'
+        self.file_id     = None
+        self.written     = set()
+
+
+    def _open_for_append(self):
+        while True:
+            f = open( self.journal_fn, 'a' )
+            fcntl.flock( f.fileno(), fcntl.LOCK_EX )
+            try:
+                if os.fstat( f.fileno() ).st_ino == os.stat( self.journal_fn ).st_ino:
+                    return f
+            except OSError:
+                pass
+            # consume() removed the file after we opened it
+            f.close()
+
+
+    def append(self, dir_paths, overflow = False):
+        f = self._open_for_append()
+        try:
+            # A recreated journal frequently reuses the old inode number so
+            # an empty file, or one changed since our last append, is
+            # treated as new and everything must be written again
+            st = os.fstat( f.fileno() )
+            if st.st_size == 0 or self.file_id != (st.st_dev, st.st_ino, st.st_ctime):
+                self.written.clear()
+
+            if overflow and not OVERFLOW in self.written:
+                f.write( OVERFLOW + '\n' )
+                self.written.add( OVERFLOW )
+
+            for p in dir_paths:
+                if not p in self.written:
+                    f.write( p.encode('string_escape') + '\n' )
+                    self.written.add( p )
+
+            f.flush()
+            os.fsync( f.fileno() )
+
+            st           = os.fstat( f.fileno() )
+            self.file_id = (st.st_dev, st.st_ino, st.st_ctime)
+        finally:
+            f.close()
+
+
+    # Moves the current entries into the snapshot and returns
+    # (overflowed, set_of_dirty_dir_paths) for everything in the snapshot
+    def consume(self):
+        with open( self.snapshot_fn, 'a' ) as snap:
+            if os.path.exists( self.journal_fn ):
+                with open( self.journal_fn, 'r' ) as f:
+                    fcntl.flock( f.fileno(), fcntl.LOCK_EX )
+                    snap.write( f.read() )
+                    os.unlink( self.journal_fn )
+            snap.flush()
+            os.fsync( snap.fileno() )
+
+        overflowed = False
+        dirty      = set()
+
+        with open( self.snapshot_fn, 'r' ) as snap:
+            for line in snap:
+                line = line.rstrip('\n')
+                if line == OVERFLOW:
+                    overflowed = True
+                elif line:
+                    dirty.add( line.decode('string_escape') )
+
+        return overflowed, dirty
+
+
+    # Called once the entries returned by consume() have been scanned
+    def clear(self):
+        if os.path.exists( self.snapshot_fn ):
+            os.unlink( self.snapshot_fn )
+
+
+
+class Watcher (object):
+
+    WATCH_MASK = (cwrap.IN_MODIFY | cwrap.IN_ATTRIB | cwrap.IN_CLOSE_WRITE |
+                  cwrap.IN_MOVED_FROM | cwrap.IN_MOVED_TO | cwrap.IN_CREATE |
+                  cwrap.IN_DELETE | cwrap.IN_DELETE_SELF | cwrap.IN_MOVE_SELF |
+                  cwrap.IN_ONLYDIR | cwrap.IN_DONT_FOLLOW)
+
+    def __init__(self, roots, journal, ignore_dirs = None, flush_interval = 1.0):
+        self.roots          = [ os.path.abspath(r) for r in roots ]
+        self.journal        = journal
+        self.ignore_dirs    = set( os.path.abspath(d) for d in ignore_dirs or () )
+        self.flush_interval = flush_interval
+        self.fd             = cwrap.inotify_init()
+        self.wd_map         = dict() # wd => directory path
+        self.pending        = set()
+        self.overflowed     = False
+        self.out_of_watches = False
+
+        # Each append to the journal fires events in its directory which
+        # would otherwise trigger another append on every flush
+        self.ignore_dirs.add( os.path.dirname(os.path.abspath(journal.journal_fn)) )
+
+
+    def add_tree(self, path):
+        for dir_path, subdirs, files in os.walk( path ):
+            if dir_path in self.ignore_dirs:
+                del subdirs[:]
+                continue
+            try:
+                wd = cwrap.inotify_add_watch( self.fd, dir_path, Watcher.WATCH_MASK )
+            except OSError, e:
+                if e.errno == errno.ENOSPC:
+                    # Out of inotify watches. The journal can no longer
+                    # be trusted
+                    if not self.out_of_watches:
+                        print 'WATCHER: inotify watch limit reached at', dir_path
+                    self.out_of_watches = True
+                    return
+                continue # Vanished or unreadable
+            self.wd_map[ wd ] = dir_path
+
+
+    def handle(self, wd, mask, name):
+        if mask & cwrap.IN_Q_OVERFLOW:
+            self.overflowed = True
+            return
+
+        if mask & cwrap.IN_IGNORED:
+            self.wd_map.pop( wd, None )
+            return
+
+        dir_path = self.wd_map.get( wd )
+
+        if dir_path is None:
+            return
+
+        self.pending.add( dir_path )
+
+        if mask & cwrap.IN_ISDIR and mask & (cwrap.IN_CREATE | cwrap.IN_MOVED_TO):
+            # Watch the new subtree. Adding a watch for an already
+            # watched inode returns its existing wd, so this also
+            # updates the paths of directories moved within the tree
+            self.add_tree( os.path.join(dir_path, name) )
+
+
+    def flush(self):
+        # Once watches could not be added, every journal must force a
+        # full scan
+        self.overflowed = self.overflowed or self.out_of_watches
+        
+        if self.pending or self.overflowed:
+            self.journal.append( sorted(self.pending), self.overflowed )
+            self.pending.clear()
+            self.overflowed = False
+
+
+    def run(self):
+        # Changes made before the watches were in place are unknown
+        self.overflowed = True
+
+        for r in self.roots:
+            self.add_tree( r )
+
+        self.flush()
+
+        print 'WATCHER: watching %d directories' % len(self.wd_map)
+
+        while True:
+            r, w, x = select.select( [self.fd], [], [], self.flush_interval )
+            if r:
+                for wd, mask, cookie, name in cwrap.inotify_read( self.fd ):
+                    self.handle( wd, mask, name )
+            self.flush()
+
+
+
+def main():
+    parser = optparse.OptionParser( usage = '%prog [options] JOURNAL_FILE ROOT [ROOT...]' )
+    parser.add_option( '-i', '--ignore', action = 'append', default = [],
+                       help = 'Directory to leave unwatched. May be repeated' )
+
+    opts, args = parser.parse_args()
+
+    if len(args) < 2:
+        parser.error( 'A journal file and at least one root directory are required' )
+
+    w = Watcher( args[1:], Journal( args[0] ), opts.ignore )
+
+    try:
+        w.run()
+    except KeyboardInterrupt:
+        w.flush()
+
+
+if __name__ == '__main__':
+    main()